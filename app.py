@@ -4,358 +4,632 @@ import sys
 # add /home/demon/.local/lib/python3.8/site-packages to the sys path
 sys.path.append("/home/demon/.local/lib/python3.8/site-packages")
 from flask import Flask, request, send_file, render_template, jsonify, Response, session, make_response
-import copy
+import hashlib
+import itertools
+import json
+import re
+import sqlite3
+import tempfile
 import traceback
-import openpyxl
-import xlrd
-import xlwt
-from xlwt import easyxf
-from xlutils.copy import copy as xl_copy
 import logging
 import io
 import threading
 import time
 from threading import Event
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import uuid
+from result_cache import ResultCache
+from incremental_store import IncrementalStore
+from history_store import HistoryStore, RunWriter
+from shared_state import SharedState
+import metrics
+from summarizer import (ON_BATCH_ROWS, PROGRESS_INTERVAL_SECONDS, SUMMARY_CHUNK_ROWS, SUMMARY_CATEGORY_ROWS, SCHEMA_PROBE_ROWS,
+                        summary_data_field_dic, large_data_field_dic, read_excel,
+                        read_excel_rows, validate_summary_data, validate_large_data, probe_workbook,
+                        probe_detail_schema, probe_summary_schema, iter_detail_records, normalize_detail_value,
+                        detail_metrics, empty_summary_row, hospital_rows, summarize_detail, summarize_detail_in_worker,
+                        merge_summaries,
+                        render_summary, StageTimings, ProcessingStopped)
 
 app = Flask(__name__)
 app.secret_key = 'supersecretkey'  # Replace with a real secret key
 UPLOAD_FOLDER = 'uploads'
 
+UPLOAD_SPOOL_BYTES = int(os.environ.get('LINGLING_UPLOAD_SPOOL_MB', 16)) * 1024 * 1024  # Larger uploads are spooled to UPLOAD_FOLDER
+
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
 ALLOWED_EXTENSIONS = {'xls', 'xlsx'}
 
-# Set up custom logger for processing
-log_streams = {}  # Dictionary to hold log streams for each session
-processing_loggers = {}  # Dictionary to hold loggers for each session
-log_seek_location = {}  # Dictionary to hold seek locations for each session
+# Cache of finished results, keyed by the content of the uploaded files
+CACHE_FOLDER = os.environ.get('LINGLING_CACHE_DIR', 'cache')
+CACHE_MAX_BYTES = int(os.environ.get('LINGLING_CACHE_MAX_MB', 512)) * 1024 * 1024
+CACHE_MAX_AGE = float(os.environ.get('LINGLING_CACHE_MAX_AGE_HOURS', 7 * 24)) * 3600
+result_cache = ResultCache(CACHE_FOLDER, CACHE_MAX_BYTES, CACHE_MAX_AGE)
+
+# Last accepted detail rows of each dataset, for incremental uploads
+DATA_FOLDER = os.environ.get('LINGLING_DATA_DIR', 'data')
+os.makedirs(DATA_FOLDER, exist_ok=True)
+incremental_store = IncrementalStore(os.environ.get('LINGLING_INCREMENTAL_DB', os.path.join(DATA_FOLDER, 'incremental.sqlite3')))
+DATASET_LOCK_TIMEOUT_SECONDS = 300  # Longest wait for another job's upload of the same dataset
+
+# Hospital rows and category totals of every accepted job, by reporting period
+history_store = HistoryStore(os.environ.get('LINGLING_HISTORY_DB', os.path.join(DATA_FOLDER, 'history.sqlite3')))
+PERIOD_PATTERN = re.compile(r'^\d{4}-(0[1-9]|1[0-2])$')  # Reporting periods are months, "YYYY-MM"
+HISTORY_MAX_HOSPITALS = 10000  # Most hospital rows a /history/hospitals request returns
+
+# Session, log and job state shared by the worker processes, see shared_state.py
+shared_state = SharedState(os.environ.get('LINGLING_STATE_DB', os.path.join(DATA_FOLDER, 'state.sqlite3')))
+SHARED_POLL_SECONDS = 0.2  # How often /logs streams look for log lines written by other processes
+CANCEL_POLL_SECONDS = 0.05  # How often active jobs look for /stop, on their stop event and in shared_state
+
+# Per-session log channels and loggers, see SessionRegistry
+SESSION_TTL_SECONDS = int(os.environ.get('LINGLING_SESSION_TTL', 3600))  # Idle time before a session is torn down
+SESSION_SWEEP_SECONDS = 60  # How often expired sessions are looked for
+SESSION_TOUCH_SECONDS = 10  # How often the activity of a session is written to shared_state
+
+LOG_CHANNEL_MAX_LINES = 1000  # Unread log lines kept per session, older ones are dropped
+LOG_CHANNEL_MAX_BYTES = 1024 * 1024  # Unread log text kept per session, older lines are dropped
+SSE_HEARTBEAT_SECONDS = 15  # Idle time before /logs sends a keep-alive comment
+sse_connections = 0  # Open /logs streams of this process
+sse_connections_lock = threading.Lock()
 
-# Event to stop processing
-stop_events = {}  # Dictionary to hold stop events for each session
+# Background job queue for uploads
+JOB_WORKERS = int(os.environ.get('LINGLING_JOB_WORKERS', 2))  # Jobs processed concurrently
+JOB_QUEUE_DEPTH = int(os.environ.get('LINGLING_JOB_QUEUE_DEPTH', 8))  # Jobs allowed to wait for a worker
+jobs = {}  # Dictionary to hold jobs by job id
+jobs_lock = threading.Lock()
+job_slots = threading.BoundedSemaphore(JOB_WORKERS + JOB_QUEUE_DEPTH)
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='lingling-job')
+
+# Process pool for uploads with several detail workbooks
+DETAIL_WORKERS = int(os.environ.get('LINGLING_DETAIL_WORKERS', os.cpu_count() or 1))  # Detail workbooks summarized in parallel
+detail_executor = None  # Created on the first multi-file upload
+detail_executor_lock = threading.Lock()
 
 def get_session_id():
     if 'session_id' not in session:
         session['session_id'] = str(uuid.uuid4())
     return session['session_id']
 
-class DiscardAfterReadIO(io.StringIO):
-    lock = {}
+class LogChannel:
+    """Log lines and progress updates of one session, kept in shared_state.
 
-    def __init__(self, initial_value='', newline='\n', session_id=None):
-        super().__init__(initial_value, newline)
-        session_id = get_session_id()
-        if session_id not in self.lock:
-            self.lock[session_id] = threading.Lock()
-        self._lock = self.lock[session_id]
+    Writes made by this process wake up its /logs streams at once; writes made
+    by other worker processes are picked up by watch_shared_logs within
+    SHARED_POLL_SECONDS. Each reader follows the log with its own cursor.
+    """
 
-    def read(self, size=-1):
-        with self._lock:
-            self.seek(0)
-            result = super().read(size)
-            self.seek(0)
-            self.truncate(0)
-            return result
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self._condition = threading.Condition()
+        self._version = 0
+        self._closed = False
+        self.readers = 0  # /logs streams waiting on the channel
+        self._shared_stamp = None  # Last shared_state.session_stamps entry seen by watch_shared_logs
 
-    def readline(self, size=-1):
-        with self._lock:
-            self.seek(0)
-            result = super().readline(size)
-            self.seek(0)
-            self.truncate(0)
-            return result
-
-    def readlines(self, hint=-1):
-        with self._lock:
-            self.seek(0)
-            result = super().readlines(hint)
-            self.seek(0)
-            self.truncate(0)
-            return result
+    def _notify(self):
+        with self._condition:
+            self._version += 1
+            self._condition.notify_all()
 
     def write(self, s):
-        with self._lock:
-            return super().write(s)
+        lines = s.splitlines()
+        if lines:
+            shared_state.append_lines(self.session_id, lines, LOG_CHANNEL_MAX_LINES, LOG_CHANNEL_MAX_BYTES)
+            self._notify()
+        return len(s)
 
-    def getvalue(self):
-        with self._lock:
-            result = super().getvalue()
-            self.seek(0)
-            self.truncate(0)
-            return result
+    def flush(self):
+        pass
+
+    def set_progress(self, progress):
+        shared_state.set_progress(self.session_id, progress)
+        self._notify()
+
+    def end_job(self, job):
+        """Tell the /logs streams that a job finished, once they have sent its last log line."""
+        shared_state.add_job_event(self.session_id, {'job_id': job.id, 'status': job.status, 'error': job.error})
+        self._notify()
+
+    def clear(self):
+        shared_state.clear_session(self.session_id)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def observe_shared(self, stamp):
+        """Wake up the readers if the session's stamp in shared_state changed since the last look."""
+        if stamp != self._shared_stamp:
+            self._shared_stamp = stamp
+            self._notify()
+
+    def wait_for_lines(self, cursor, timeout):
+        """Block until lines, progress or job events are written after cursor, then read them.
+
+        cursor is None for a new reader. Returns (lines, progress, job events,
+        cursor), with empty lists and None on timeout, or None once the channel
+        is closed. Job events only come once the lines before them were read.
+        """
+        line_seq, progress_seq, event_id = cursor or (0, 0, 0)
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self.readers += 1
+        try:
+            return self._wait_for_lines(line_seq, progress_seq, event_id, deadline)
+        finally:
+            with self._condition:
+                self.readers -= 1
+
+    def _wait_for_lines(self, line_seq, progress_seq, event_id, deadline):
+        while True:
+            with self._condition:
+                version = self._version
+            # Every line up to log_end is read below, unless it was cleared
+            log_end = shared_state.log_end(self.session_id)
+            lines, last_seq, dropped = shared_state.read_lines(self.session_id, line_seq)
+            new_progress_seq, progress = shared_state.read_progress(self.session_id)
+            if new_progress_seq == progress_seq:
+                progress = None
+            events, new_event_id = shared_state.read_job_events(self.session_id, event_id, max(last_seq, log_end))
+            remaining = deadline - time.monotonic()
+            if lines or progress or events or remaining <= 0:
+                if dropped:
+                    lines.insert(0, f"... {dropped} earlier log lines were dropped")
+                return lines, progress, events, (last_seq, new_progress_seq, new_event_id)
+            with self._condition:
+                self._condition.wait_for(lambda: self._version != version or self._closed, remaining)
+                if self._closed:
+                    return None
+
+class ProgressReporter:
+    """Rate-limited progress updates of a job, pushed to the session's /logs stream."""
+
+    def __init__(self, job, log_channel, min_interval=PROGRESS_INTERVAL_SECONDS):
+        self.job = job
+        self.log_channel = log_channel
+        self.min_interval = min_interval
+        self._last_update = 0.0
+
+    def __call__(self, final=False, **progress):
+        now = time.monotonic()
+        if not final and now - self._last_update < self.min_interval:
+            return
+        self._last_update = now
+        progress['job_id'] = self.job.id
+        self.job.progress = progress
+        self.log_channel.set_progress(progress)
+        self.job.publish()
 
 def get_logger(session_id):
-    if session_id not in log_streams:
-        log_streams[session_id] = DiscardAfterReadIO()
-        processing_logger = logging.getLogger(session_id)
-        processing_logger.setLevel(logging.INFO)
-        log_handler = logging.StreamHandler(log_streams[session_id])
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        log_handler.setFormatter(formatter)
-        processing_logger.addHandler(log_handler)
-        processing_loggers[session_id] = processing_logger
-    return processing_loggers[session_id]
+    return sessions.get(session_id).processing_logger
 
-def get_stop_event(session_id):
-    if session_id not in stop_events:
-        stop_events[session_id] = Event()
-    return stop_events[session_id]
+class Job:
+    """One upload waiting for or running on the job pool."""
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    def __init__(self, session_state):
+        self.id = str(uuid.uuid4())
+        self.session_id = session_state.session_id
+        self.processing_logger = session_state.processing_logger
+        self.log_channel = session_state.log_channel
+        self.stop_event = Event()
+        self.status = 'queued'  # queued -> running -> done | failed | cancelled
+        self.error = None
+        self.stack_trace = None
+        self.large_excels = []  # SpooledUpload of each detail workbook
+        self.summary_excel = None
+        self.output_path = None  # Rendered workbook in the result cache...
+        self.output_data = None  # ...or in memory if it could not be cached
+        self.summary = None  # Summarized data, by hospital category
+        self.progress = None  # Latest ProgressReporter update
+        self.row_log = False  # Log every hospital row as JSON
+        self.dataset = None  # Set for incremental uploads, see summarize_incremental
+        self.changes = None  # Hospitals added, changed and removed by an incremental upload
+        self.incremental_changes = None  # Uncommitted incremental_store changes, and the DatasetLock held meanwhile
+        self.dataset_lock = None
+        self.history_dataset = 'default'  # Dataset and reporting period the job is recorded under in history_store
+        self.period = None
+        self.history_run = None  # Pending history_store run, while the job runs
+        self.cache_key = None
+        self.cache_hit = False
+        self.timings = StageTimings()
+        self.input_bytes = 0
+        self.created = time.time()
+        self.started = None
+        self.stop_requested = None
+        self.finished = None
 
-def read_excel(file_path, processing_logger, stop_event):
-    processing_logger.info(f"Reading file: {file_path}")
-    if stop_event.is_set():
-        processing_logger.warning("Processing stopped by user during file read.")
-        return None, None, None
-    try:
-        if file_path.endswith('.xlsx'):
-            wb = openpyxl.load_workbook(file_path)
-            sheet = wb.active
-            data = [[cell.value for cell in row] for row in sheet.iter_rows()]
-            return data, wb, sheet
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'stack_trace': self.stack_trace,
+            'summary': self.summary,
+            'progress': self.progress,
+            'cache_hit': self.cache_hit,
+            'changes': self.changes,
+            'period': self.period,
+            'timings': self.timing_breakdown(),
+            'stopped': self.stopped_at(),
+            'created': self.created,
+            'finished': self.finished,
+        }
+
+    def timing_breakdown(self):
+        """Seconds per stage, rows, throughput and input size of the job so far."""
+        run_seconds = ((self.finished or time.time()) - self.started) if self.started else None
+        return {
+            # A copy, as /stop may publish the job while a stage is being added
+            'stages': {name: round(seconds, 4) for name, seconds in self.timings.seconds.copy().items()},
+            'queued_seconds': round((self.started or self.finished or time.time()) - self.created, 4),
+            'run_seconds': round(run_seconds, 4) if run_seconds is not None else None,
+            'rows': self.timings.rows,
+            'rows_per_second': round(self.timings.rows / run_seconds) if self.timings.rows and run_seconds else None,
+            'input_bytes': self.input_bytes,
+            'peak_rss_bytes': self.timings.peak_rss or None,
+        }
+
+    def stopped_at(self):
+        """Stage and rows a cancelled job had reached, and how long it took to stop."""
+        if self.stop_requested is None or self.status != 'cancelled':
+            return None
+        return {
+            'stage': self.timings.current,
+            'rows': self.timings.rows,
+            'stop_seconds': round(self.finished - self.stop_requested, 4) if self.finished else None,
+        }
+
+    def publish(self):
+        """Write the job's current state to shared_state, for /jobs requests served by any process."""
+        output_name = self.summary_excel.filename if self.summary_excel is not None else None
+        shared_state.save_job(self.id, self.session_id, self.to_dict(), self.output_path, output_name)
+
+class SpooledUpload:
+    """An uploaded file, kept in memory unless it is larger than UPLOAD_SPOOL_BYTES.
+
+    Large uploads are copied to a job-private temp file in UPLOAD_FOLDER. The
+    SHA-256 digest of the content is computed while the upload is copied.
+    """
+
+    def __init__(self, file_storage, job_id):
+        self.filename = file_storage.filename
+        self.path = None
+        self.contents = None
+        digest = hashlib.sha256()
+        head = file_storage.stream.read(UPLOAD_SPOOL_BYTES + 1)
+        digest.update(head)
+        self.size = len(head)
+        if len(head) <= UPLOAD_SPOOL_BYTES:
+            self.contents = head
         else:
-            book = xlrd.open_workbook(file_path, formatting_info=True)
-            sheet = book.sheet_by_index(0)
-            data = [sheet.row_values(rowx) for rowx in range(sheet.nrows)]
-            return data, book, sheet
-    except Exception as e:
-        processing_logger.error(f"Error reading file: {e}")
-        return None, None, None
-
-def field_verify(fields_dict, data_line):
-    for location, field_name in fields_dict.items():
-        if field_name not in data_line[location]:
-            raise ValueError(f"Field '{field_name}' not found in {data_line}.")
-
-summary_data_field_dic = {
-    0: "医疗机构分类",
-    1: "医院总数量",
-    2: "参加国家卫生健康委员会临床检验中心室间质量评价合格医院数量",
-    3: "通过国家室间质评平均合格项目数量",
-    4: "参加辽宁省临床检验中心室间质量评价合格医院数量",
-    5: "通过辽宁省室间质评平均合格项目数量",
-    6: "参加辽宁省医学影像质控中心影像质控认证评价合格医院数量",
-    7: "要求对其他医疗机构标有互认标识的医学影像检查资料和医学检验结果认可的医院数量",
-    8: "认可其他医疗机构标有互认标识的医学影像检查资料和医学检验结果",
-    9: "联盟医院间通过信息系统调阅成员医院间医学影像检查资料和医学检验结果频次合计",
-    10: "实施检查检验结果互认为患者节约医疗费用",
-}
-
-summary_data_field_data_type = {
-    summary_data_field_dic[0]: 0,
-    summary_data_field_dic[1]: 0,
-    summary_data_field_dic[2]: 0,
-    summary_data_field_dic[3]: 0,
-    summary_data_field_dic[4]: 0,
-    summary_data_field_dic[5]: 0,
-    summary_data_field_dic[6]: 0,
-    summary_data_field_dic[7]: 0,
-    summary_data_field_dic[8]: 0,
-    summary_data_field_dic[9]: 0,
-    summary_data_field_dic[10]: 0.0,
-}
-
-large_data_field_dic = {
-    0: "医疗机构名称",
-    1: "医疗机构分类",
-    2: "是否参加国家卫生健康委员会临床检验中心室间质量评价并合格",
-    3: "通过国家室间质评医学检验结果合格项目数量",
-    4: "是否参加辽宁省临床检验中心室间质量评价并合格",
-    5: "通过辽宁省室间质评医学检验结果合格项目数量",
-    6: "是否参加辽宁省医学影像质控中心影像质控认证评价并合格",
-    7: "要求对其他医疗机构标有互认标识的医学影像检查资料和医学检验结果认可",
-    8: "DR互认项目数",
-    9: "DR节约检查费用",
-    10: "MR互认项目数",
-    11: "MR节约检查费用",
-    12: "CT互认项目数",
-    13: "CT节约检查费用",
-    14: "临床检验互认项目数",
-    15: "临床检验节约检查费用",
-    16: "通过信息系统调阅成员医院间医学影像检查资料和医学检验结果频",
-    # 17: "总项目",
-    # 18: "总费用",
-}
-
-
-def validate_summary_data(file_name, summary_data, processing_logger):
-    processing_logger.info(f"Validating data for: {file_name}")
-    fields_dict = summary_data_field_dic
-    data_line = summary_data[3]
-    field_verify(fields_dict, data_line)
-    if "三级甲等医院" not in summary_data[4][0]:
-        raise ValueError("三级甲等医院 is not in row 5, column 1")
-    if "三级公立医院" not in summary_data[5][0]:
-        raise ValueError("三级公立医院 is not in row 6, column 1")
-    if "三级民营医院" not in summary_data[6][0]:
-        raise ValueError("三级民营医院 is not in row 7, column 1")
-    if "二级公立医院" not in summary_data[7][0]:
-        raise ValueError("二级公立医院 is not in row 8, column 1")
-    if "二级民营医院" not in summary_data[8][0]:
-        raise ValueError("二级民营医院 is not in row 9, column 1")
-
-    processing_logger.info(f"Data validation successful for {file_name}.")
-
-
-def validate_large_data(file_name, large_data, processing_logger):
-    processing_logger.info(f"Validating data for: {file_name}")
-    fields_dict = large_data_field_dic
-    data_line = large_data[4]
-    field_verify(fields_dict, data_line)
-    processing_logger.info(f"Data validation successful for {file_name}.")
-
-
-def get_one_row_data(rows):
-    start_yield = False
-    for row in rows:
-        if not isinstance(row[0], str):
-            continue
-        if "总计" in row[0]:
-            break
-    else:
-        raise ValueError("No '总计' row found in large Excel data.")
+            suffix = os.path.splitext(self.filename)[1]
+            fd, self.path = tempfile.mkstemp(prefix=f"{job_id}-", suffix=suffix, dir=UPLOAD_FOLDER)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(head)
+                for chunk in iter(lambda: file_storage.stream.read(1024 * 1024), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    self.size += len(chunk)
+        self.digest = digest.digest()
 
-    found = False
-    for row in rows:
-        if not isinstance(row[0], str):
-            continue
-        if "总计" in row[0]:
-            found = True
-        if found and "注" in row[0]:
-            break
-    else:
-        raise ValueError("No '注' row found in large Excel data.")
+    @property
+    def file_path(self):
+        """Path handed to the Excel readers; in-memory uploads only use it for the extension."""
+        return self.path or self.filename
 
-    for row in rows:
-        if not isinstance(row[0], str):
-            continue
-        if "总计" in row[0]:
-            start_yield = True
+    def discard(self):
+        self.contents = None
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+def discard_uploads(job):
+    for upload in job.large_excels + [job.summary_excel]:
+        if upload is not None:
+            upload.discard()
+
+def worker_stop_path(job):
+    """File whose existence tells the detail workers of a job to stop, see StopFile."""
+    return os.path.join(UPLOAD_FOLDER, f"{job.id}.stop")
+
+def check_upload_schemas(job):
+    """Probe the first rows of every .xlsx upload; returns an error message, or None if they all look right.
+
+    Runs before the job is queued, so a wrong file is turned away without
+    parsing it in full. xlrd reads a whole .xls sheet to get at its first
+    rows, so .xls uploads are only validated by the job, from the sheet it
+    parses anyway.
+    """
+    checks = [(upload, probe_detail_schema) for upload in job.large_excels] + [(job.summary_excel, probe_summary_schema)]
+    for upload, probe in checks:
+        if not upload.file_path.endswith('.xlsx'):
             continue
-        if "注" in row[0]:
-            return
-        if start_yield:
-            yield_dict = dict()
-            for idx, value in enumerate(row):
-                if idx >= len(large_data_field_dic):
-                    break
-                if not value:
-                    value = 0
-                if value == r'/':
-                    value = 0
-                dict_key = large_data_field_dic[idx]
-                yield_dict[dict_key] = value
-            yield yield_dict
-
-
-def summarize_large_data(large_data, processing_logger, stop_event):
-    processing_logger.info("Summarizing large Excel data")
-    if stop_event.is_set():
-        processing_logger.warning("Processing stopped by user during summarization.")
+        started = time.monotonic()
+        try:
+            schema = probe_workbook(upload.filename, upload.file_path, probe, job.processing_logger,
+                                    file_contents=upload.contents)
+        except ValueError as e:
+            return str(e)
+        job.processing_logger.info(f"{upload.filename}: header found in row {schema.header_row + 1} "
+                                   f"({(time.monotonic() - started) * 1000:.0f} ms)")
+    return None
+
+def result_cache_key(job):
+    schema = {'summary_data_field_dic': summary_data_field_dic, 'large_data_field_dic': large_data_field_dic}
+    digests = [upload.digest for upload in job.large_excels] + [job.summary_excel.digest]
+    return ResultCache.make_key(digests, schema)
+
+def record_job_metrics(job):
+    """Add a finished job's timings, throughput, input size and memory to the /metrics histograms."""
+    observations = [metrics.observation('lingling_stage_seconds', seconds, stage=name)
+                    for name, seconds in job.timings.seconds.copy().items()]
+    observations.append(metrics.observation('lingling_job_seconds', job.finished - job.created, status=job.status))
+    observations.append(metrics.observation('lingling_job_input_bytes', job.input_bytes))
+    breakdown = job.timing_breakdown()
+    if breakdown['rows_per_second'] is not None and job.status == 'done':
+        observations.append(metrics.observation('lingling_job_rows_per_second', breakdown['rows_per_second']))
+    if job.timings.peak_rss:
+        observations.append(metrics.observation('lingling_job_peak_rss_bytes', job.timings.peak_rss))
+    try:
+        shared_state.observe(observations)
+    except Exception:
+        app.logger.exception("Recording the metrics of a job failed")
+
+def begin_history_run(job):
+    """Open the pending history_store run of a job; the job goes on without one if the store fails."""
+    try:
+        job.history_run = history_store.begin_run(
+            job.history_dataset, job.period, job.id, [upload.filename for upload in job.large_excels],
+            list(large_data_field_dic.values()), list(summary_data_field_dic.values()))
+    except sqlite3.Error as e:
+        job.processing_logger.warning(f"Could not record the job in the history: {e}")
+
+def record_hospitals(job, records):
+    """Add a batch of raw detail records to the job's pending history run."""
+    if job.history_run is None:
+        return
+    try:
+        history_store.add_hospitals(job.history_run, job.history_dataset, job.period, hospital_rows(records))
+    except sqlite3.Error as e:
+        job.processing_logger.warning(f"Could not record the job in the history: {e}")
+        discard_history_run(job)
+
+def discard_history_run(job):
+    run_id, job.history_run = job.history_run, None
+    try:
+        history_store.discard_run(run_id)
+    except sqlite3.Error:
+        app.logger.exception("Discarding a history run failed")
+
+def finish_history_run(job):
+    """Accept the history run of a done job as the one of its period, drop it otherwise."""
+    if job.history_run is None:
+        return
+    if job.status != 'done':
+        discard_history_run(job)
+        return
+    try:
+        hospital_count = history_store.accept_run(job.history_run, job.summary, job.cache_key)
+        job.history_run = None
+        job.processing_logger.info(f"Recorded {hospital_count} hospitals under period {job.period} "
+                                   f"of dataset {job.history_dataset} in the history.")
+    except sqlite3.Error as e:
+        job.processing_logger.warning(f"Could not record the job in the history: {e}")
+        discard_history_run(job)
+
+def record_cached_history(job):
+    """Record a job answered from the result cache, with the hospital rows of the run that filled the cache.
+
+    Runs on job_executor, so /upload answers without waiting for the copy.
+    """
+    begin_history_run(job)
+    if job.history_run is None:
+        return
+    try:
+        if not history_store.copy_hospitals(job.history_run, job.cache_key):
+            job.processing_logger.info("The hospital rows of this result are not in the history, "
+                                       "only its category totals are recorded.")
+    except sqlite3.Error as e:
+        job.processing_logger.warning(f"Could not record the job in the history: {e}")
+        discard_history_run(job)
+    finish_history_run(job)
+
+def get_job_record(session_id, job_id):
+    """The shared_state record of a job of the session, whichever process runs it."""
+    record = shared_state.load_job(job_id)
+    if record is None or record['session_id'] != session_id:
         return None
+    return record
 
-    hospital_data = {
-        "三级甲等医院": copy.deepcopy(summary_data_field_data_type),
-        "三级公立医院": copy.deepcopy(summary_data_field_data_type),
-        "三级民营医院": copy.deepcopy(summary_data_field_data_type),
-        "二级公立医院": copy.deepcopy(summary_data_field_data_type),
-        "二级民营医院": copy.deepcopy(summary_data_field_data_type),
-    }
+def cancel_job(job):
+    """Stop a job of this process; returns whether it was still queued or running."""
+    with jobs_lock:
+        if job.status not in ('queued', 'running'):
+            return False
+        job.stop_event.set()
+        job.stop_requested = time.time()
+        if job.status == 'queued':
+            job.status = 'cancelled'
+            job.finished = time.time()
+    job.publish()
+    return True
 
+def cancel_session_jobs(session_id):
+    """Stop every queued or running job of a session, in any process."""
+    cancelled = shared_state.request_cancel(session_id)
+    with jobs_lock:
+        local_jobs = [job for job in jobs.values() if job.session_id == session_id]
+    for job in local_jobs:
+        cancel_job(job)
+    return len(cancelled)
 
-    for row_dict in get_one_row_data(large_data):
-        医疗机构名称 = row_dict["医疗机构名称"]
-        医疗机构分类 = row_dict["医疗机构分类"]
-        是否参加国家卫生健康委员会临床检验中心室间质量评价并合格 = row_dict["是否参加国家卫生健康委员会临床检验中心室间质量评价并合格"]
-        通过国家室间质评医学检验结果合格项目数量 = row_dict["通过国家室间质评医学检验结果合格项目数量"]
-        是否参加辽宁省临床检验中心室间质量评价并合格 = row_dict["是否参加辽宁省临床检验中心室间质量评价并合格"]
-        通过辽宁省室间质评医学检验结果合格项目数量 = row_dict["通过辽宁省室间质评医学检验结果合格项目数量"]
-        是否参加辽宁省医学影像质控中心影像质控认证评价并合格 = row_dict["是否参加辽宁省医学影像质控中心影像质控认证评价并合格"]
-        要求对其他医疗机构标有互认标识的医学影像检查资料和医学检验结果认可 = row_dict["要求对其他医疗机构标有互认标识的医学影像检查资料和医学检验结果认可"]
-        DR互认项目数 = row_dict["DR互认项目数"]
-        DR节约检查费用 = row_dict["DR节约检查费用"]
-        MR互认项目数 = row_dict["MR互认项目数"]
-        MR节约检查费用 = row_dict["MR节约检查费用"]
-        CT互认项目数 = row_dict["CT互认项目数"]
-        CT节约检查费用 = row_dict["CT节约检查费用"]
-        临床检验互认项目数 = row_dict["临床检验互认项目数"]
-        临床检验节约检查费用 = row_dict["临床检验节约检查费用"]
-        通过信息系统调阅成员医院间医学影像检查资料和医学检验结果频 = row_dict["通过信息系统调阅成员医院间医学影像检查资料和医学检验结果频"]
-        # 总项目 = row_dict["总项目"]
-        # 总费用 = row_dict["总费用"]
-        Process_data = (
-            f"\n <---- .... ---->\n"
-            f"医疗机构名称: {医疗机构名称}\n"
-            f"    医疗机构分类: {医疗机构分类}\n"
-            f"    是否参加国家卫生健康委员会临床检验中心室间质量评价并合格: {是否参加国家卫生健康委员会临床检验中心室间质量评价并合格}\n"
-            f"    通过国家室间质评医学检验结果合格项目数量: {通过国家室间质评医学检验结果合格项目数量}\n"
-            f"    是否参加辽宁省临床检验中心室间质量评价并合格: {是否参加辽宁省临床检验中心室间质量评价并合格}\n"
-            f"    通过辽宁省室间质评医学检验结果合格项目数量: {通过辽宁省室间质评医学检验结果合格项目数量}\n"
-            f"    是否参加辽宁省医学影像质控中心影像质控认证评价并合格: {是否参加辽宁省医学影像质控中心影像质控认证评价并合格}\n"
-            f"    要求对其他医疗机构标有互认标识的医学影像检查资料和医学检验结果认可: {要求对其他医疗机构标有互认标识的医学影像检查资料和医学检验结果认可}\n"
-            f"    DR互认项目数: {DR互认项目数}\n"
-            f"    DR节约检查费用: {DR节约检查费用}\n"
-            f"    MR互认项目数: {MR互认项目数}\n"
-            f"    MR节约检查费用: {MR节约检查费用}\n"
-            f"    CT互认项目数: {CT互认项目数}\n"
-            f"    CT节约检查费用: {CT节约检查费用}\n"
-            f"    临床检验互认项目数: {临床检验互认项目数}\n"
-            f"    临床检验节约检查费用: {临床检验节约检查费用}\n"
-            f"    通过信息系统调阅成员医院间医学影像检查资料和医学检验结果频: {通过信息系统调阅成员医院间医学影像检查资料和医学检验结果频}\n"
-            # f"    总项目: {总项目}\n"
-            # f"    总费用: {总费用}\n"
-        )
-        processing_logger.info(Process_data)
-
-        hospital_data[医疗机构分类]["医院总数量"] += 1
-        if 是否参加辽宁省医学影像质控中心影像质控认证评价并合格 not in [0, 1]:
-            raise ValueError(f"Invalid value for '是否参加辽宁省医学影像质控中心影像质控认证评价并合格': {是否参加辽宁省医学影像质控中心影像质控认证评价并合格}")
-
-        if 是否参加国家卫生健康委员会临床检验中心室间质量评价并合格:
-            hospital_data[医疗机构分类]["参加国家卫生健康委员会临床检验中心室间质量评价合格医院数量"] += 1
-        hospital_data[医疗机构分类]["通过国家室间质评平均合格项目数量"] += int(通过国家室间质评医学检验结果合格项目数量)
-        hospital_data[医疗机构分类]["参加辽宁省临床检验中心室间质量评价合格医院数量"] += int(是否参加辽宁省临床检验中心室间质量评价并合格)
-        hospital_data[医疗机构分类]["通过辽宁省室间质评平均合格项目数量"] += int(通过辽宁省室间质评医学检验结果合格项目数量)
-        hospital_data[医疗机构分类]["参加辽宁省医学影像质控中心影像质控认证评价合格医院数量"] += int(是否参加辽宁省医学影像质控中心影像质控认证评价并合格)
-        hospital_data[医疗机构分类]["要求对其他医疗机构标有互认标识的医学影像检查资料和医学检验结果认可的医院数量"] += int(要求对其他医疗机构标有互认标识的医学影像检查资料和医学检验结果认可)
-        hospital_data[医疗机构分类]["认可其他医疗机构标有互认标识的医学影像检查资料和医学检验结果"] += int(DR互认项目数) + int(MR互认项目数) + int(CT互认项目数) + int(临床检验互认项目数)
-        hospital_data[医疗机构分类]["联盟医院间通过信息系统调阅成员医院间医学影像检查资料和医学检验结果频次合计"] += int(通过信息系统调阅成员医院间医学影像检查资料和医学检验结果频)
-        hospital_data[医疗机构分类]["实施检查检验结果互认为患者节约医疗费用"] += float(DR节约检查费用) + float(MR节约检查费用) + float(CT节约检查费用) + float(临床检验节约检查费用)
-
-        warning_process_data = (
-            f"\n <---- .... ---->\n"
-            f"医疗机构分类: {医疗机构分类}\n"
-            f"    医院总数量: {hospital_data[医疗机构分类]['医院总数量']}\n"
-            f"    参加国家卫生健康委员会临床检验中心室间质量评价合格医院数量: {hospital_data[医疗机构分类]['参加国家卫生健康委员会临床检验中心室间质量评价合格医院数量']}\n"
-            f"    通过国家室间质评平均合格项目数量: {hospital_data[医疗机构分类]['通过国家室间质评平均合格项目数量']}\n"
-            f"    参加辽宁省临床检验中心室间质量评价合格医院数量: {hospital_data[医疗机构分类]['参加辽宁省临床检验中心室间质量评价合格医院数量']}\n"
-            f"    通过辽宁省室间质评平均合格项目数量: {hospital_data[医疗机构分类]['通过辽宁省室间质评平均合格项目数量']}\n"
-            f"    参加辽宁省医学影像质控中心影像质控认证评价合格医院数量: {hospital_data[医疗机构分类]['参加辽宁省医学影像质控中心影像质控认证评价合格医院数量']}\n"
-            f"    要求对其他医疗机构标有互认标识的医学影像检查资料和医学检验结果认可的医院数量: {hospital_data[医疗机构分类]['要求对其他医疗机构标有互认标识的医学影像检查资料和医学检验结果认可的医院数量']}\n"
-            f"    认可其他医疗机构标有互认标识的医学影像检查资料和医学检验结果: {hospital_data[医疗机构分类]['认可其他医疗机构标有互认标识的医学影像检查资料和医学检验结果']}\n"
-            f"    联盟医院间通过信息系统调阅成员医院间医学影像检查资料和医学检验结果频次合计: {hospital_data[医疗机构分类]['联盟医院间通过信息系统调阅成员医院间医学影像检查资料和医学检验结果频次合计']}\n"
-            f"    实施检查检验结果互认为患者节约医疗费用: {hospital_data[医疗机构分类]['实施检查检验结果互认为患者节约医疗费用']}\n"   
-        )
-        # processing_logger.warning(warning_process_data)
-    summary_data = dict()
-    for key, value in hospital_data.items():
-        value_list = []
-        value_list.append(value["医院总数量"])
-        value_list.append(value["参加国家卫生健康委员会临床检验中心室间质量评价合格医院数量"])
-        value_list.append(value["通过国家室间质评平均合格项目数量"])
-        value_list.append(value["参加辽宁省临床检验中心室间质量评价合格医院数量"])
-        value_list.append(value["通过辽宁省室间质评平均合格项目数量"])
-        value_list.append(value["参加辽宁省医学影像质控中心影像质控认证评价合格医院数量"])
-        value_list.append(value["要求对其他医疗机构标有互认标识的医学影像检查资料和医学检验结果认可的医院数量"])
-        value_list.append(value["认可其他医疗机构标有互认标识的医学影像检查资料和医学检验结果"])
-        value_list.append(value["联盟医院间通过信息系统调阅成员医院间医学影像检查资料和医学检验结果频次合计"])
-        value_list.append(value["实施检查检验结果互认为患者节约医疗费用"])
-        summary_data[key] = value_list
+def watch_cancellations():
+    """Stop the jobs of this process that /stop cancelled in another process.
 
-    return summary_data
+    Looks every CANCEL_POLL_SECONDS; shared_state is only queried while this
+    process has active jobs.
+    """
+    while True:
+        time.sleep(CANCEL_POLL_SECONDS)
+        try:
+            with jobs_lock:
+                active = {job.id: job for job in jobs.values()
+                          if job.status in ('queued', 'running') and not job.stop_event.is_set()}
+            for job_id in shared_state.cancel_requested(active):
+                cancel_job(active[job_id])
+        except Exception:
+            app.logger.exception("Checking for cancelled jobs failed")
+
+def watch_shared_logs():
+    """Wake up the /logs streams of this process when another process writes to their session.
+
+    One query every SHARED_POLL_SECONDS covers every session with a waiting
+    stream, so the streams themselves only block on their channel.
+    """
+    while True:
+        time.sleep(SHARED_POLL_SECONDS)
+        try:
+            channels = sessions.waiting_log_channels()
+            stamps = shared_state.session_stamps([channel.session_id for channel in channels])
+            for channel in channels:
+                channel.observe_shared(stamps.get(channel.session_id))
+        except Exception:
+            app.logger.exception("Checking for shared log lines failed")
+
+def session_has_active_jobs(session_id):
+    with jobs_lock:
+        return any(job.session_id == session_id and job.status in ('queued', 'running') for job in jobs.values())
+
+def drop_session_jobs(session_id):
+    """Forget the finished jobs of a session."""
+    with jobs_lock:
+        for job in [job for job in jobs.values() if job.session_id == session_id]:
+            del jobs[job.id]
+
+class SessionState:
+    """Log channel and processing logger of one browser session."""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.log_channel = LogChannel(session_id)
+        # A bare Logger rather than logging.getLogger(session_id): getLogger
+        # keeps every logger it creates for the lifetime of the process.
+        self.processing_logger = logging.Logger(session_id, logging.INFO)
+        log_handler = logging.StreamHandler(self.log_channel)
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        log_handler.setFormatter(formatter)
+        self.processing_logger.addHandler(log_handler)
+        self.last_seen = time.monotonic()
+        self._last_shared_touch = None
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+        if self._last_shared_touch is None or self.last_seen - self._last_shared_touch > SESSION_TOUCH_SECONDS:
+            self._last_shared_touch = self.last_seen
+            shared_state.touch_session(self.session_id)
+
+    def close(self):
+        for handler in list(self.processing_logger.handlers):
+            self.processing_logger.removeHandler(handler)
+            handler.close()
+        # Ends any /logs stream still attached to the session
+        self.log_channel.close()
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class SessionRegistry:
+    """Live sessions, torn down once idle for longer than ttl seconds.
+
+    A session stays alive while it makes requests, has an open /logs stream
+    or has queued or running jobs. Each process keeps the SessionState of the
+    sessions it served; their logs and jobs in shared_state are dropped once
+    the session is idle in every process.
+    """
+
+    def __init__(self, ttl, sweep_interval):
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            session_state = self._sessions.get(session_id)
+            if session_state is None:
+                session_state = self._sessions[session_id] = SessionState(session_id)
+        session_state.touch()
+        return session_state
+
+    def sweep(self):
+        """Tear down expired sessions and return how many there were."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [session_state for session_state in self._sessions.values()
+                       if now - session_state.last_seen > self.ttl
+                       and not session_has_active_jobs(session_state.session_id)]
+            for session_state in expired:
+                del self._sessions[session_state.session_id]
+        for session_state in expired:
+            session_state.close()
+            drop_session_jobs(session_state.session_id)
+        shared_state.fail_orphaned_jobs(process_alive)
+        return len(shared_state.expire_sessions(self.ttl))
+
+    def waiting_log_channels(self):
+        """Log channels of this process's sessions that /logs streams wait on."""
+        with self._lock:
+            return [session_state.log_channel for session_state in self._sessions.values()
+                    if session_state.log_channel.readers]
+
+    def gauges(self):
+        """Number of live sessions and the log bytes they hold, over all processes."""
+        return shared_state.gauges()
+
+    def start_sweeper(self):
+        thread = threading.Thread(target=self._sweep_forever, name='lingling-session-sweeper', daemon=True)
+        thread.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                expired = self.sweep()
+                if expired:
+                    app.logger.info(f"Expired {expired} idle sessions, {self.gauges()}")
+            except Exception:
+                app.logger.exception("Session sweep failed")
+
+sessions = SessionRegistry(SESSION_TTL_SECONDS, SESSION_SWEEP_SECONDS)
+sessions.start_sweeper()
+threading.Thread(target=watch_cancellations, name='lingling-cancel-watcher', daemon=True).start()
+threading.Thread(target=watch_shared_logs, name='lingling-log-watcher', daemon=True).start()
+
+def get_detail_executor(discard_broken=None):
+    global detail_executor
+    with detail_executor_lock:
+        if discard_broken is not None and detail_executor is discard_broken:
+            # A worker died; the pool can't be used again
+            detail_executor.shutdown(wait=False)
+            detail_executor = None
+        if detail_executor is None:
+            # spawn rather than fork: the server process is multi-threaded
+            detail_executor = ProcessPoolExecutor(max_workers=DETAIL_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return detail_executor
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
 @app.route('/')
@@ -366,169 +640,395 @@ def index():
     response.headers['Expires'] = '0'
     return response
 
-def stream_logs(session_id):
-    while True:
-        if session_id not in log_streams:
-            break
-        log_stream = log_streams[session_id]
-        logs = log_stream.read()
-        if logs:
-            for line in logs.splitlines():
-                yield f"data: {line}\n\n"
-            # Clearing the log stream for the current session while retaining the log data
-        time.sleep(1)
+def count_sse_connection(delta):
+    global sse_connections
+    with sse_connections_lock:
+        sse_connections += delta
+        shared_state.set_process_gauge('sse_connections', sse_connections)
+
+def stream_logs(session_state):
+    # Lines are pushed as soon as they are logged; everything written since the
+    # last frame goes out as one multi-line SSE event, and the latest progress
+    # update as a separate "progress" event. Heartbeats let the server notice a
+    # closed connection while the session is idle.
+    count_sse_connection(1)
+    try:
+        # Servers send the headers, and with them the session cookie, along with
+        # the first chunk, so don't keep it waiting for the first log line
+        yield ": connected\n\n"
+        cursor = None
+        while True:
+            events = session_state.log_channel.wait_for_lines(cursor, SSE_HEARTBEAT_SECONDS)
+            if events is None:
+                break
+            # An open log stream keeps the session alive
+            session_state.touch()
+            lines, progress, job_events, cursor = events
+            if progress:
+                yield f"event: progress\ndata: {json.dumps(progress, ensure_ascii=False, separators=(',', ':'))}\n\n"
+            if lines:
+                yield "".join(f"data: {line}\n" for line in lines) + "\n"
+            # After the lines: a "job" event means the job's log is complete
+            for job_event in job_events:
+                yield f"event: job\ndata: {json.dumps(job_event, ensure_ascii=False, separators=(',', ':'))}\n\n"
+            if not lines and not progress and not job_events:
+                yield ": heartbeat\n\n"
+    finally:
+        count_sse_connection(-1)
 
 @app.route('/logs')
 def logs():
-    session_id = get_session_id()
-    response = Response(stream_logs(session_id), mimetype='text/event-stream')
+    session_state = sessions.get(get_session_id())
+    response = Response(stream_logs(session_state), mimetype='text/event-stream')
     response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
+    response.headers['X-Accel-Buffering'] = 'no'  # Don't let a reverse proxy hold back events
     return response
 
-def get_xlwt_style(xlrd_book, xlrd_sheet, row, col):
-    """Get the xlwt style from an xlrd cell."""
-    # Get the XF index of the cell in xlrd
-    xf_index = xlrd_sheet.cell_xf_index(row, col)
-    xf = xlrd_book.xf_list[xf_index]
-    
-    # Create an xlwt font
-    font = xlrd_book.font_list[xf.font_index]
-    xlwt_font = xlwt.Font()
-    xlwt_font.height = font.height
-    xlwt_font.italic = font.italic
-    xlwt_font.struck_out = font.struck_out
-    xlwt_font.outline = font.outline
-    xlwt_font.shadow = font.shadow
-    xlwt_font.colour_index = font.colour_index
-    xlwt_font.bold = font.bold
-    xlwt_font._weight = font.weight
-    xlwt_font.escapement = font.escapement
-    xlwt_font.underline = font.underline_type
-    xlwt_font.family = font.family  # Preserve font family
-    xlwt_font.name = font.name  # Preserve font family
-    xlwt_font.charset = font.character_set
-
-    # Create an xlwt borders
-    borders = xlwt.Borders()
-    borders.left = xf.border.left_line_style
-    borders.right = xf.border.right_line_style
-    borders.top = xf.border.top_line_style
-    borders.bottom = xf.border.bottom_line_style
-    borders.left_colour = xf.border.left_colour_index
-    borders.right_colour = xf.border.right_colour_index
-    borders.top_colour = xf.border.top_colour_index
-    borders.bottom_colour = xf.border.bottom_colour_index
-
-    # Create an xlwt alignment
-    alignment = xlwt.Alignment()
-    alignment.horz = xf.alignment.hor_align
-    alignment.vert = xf.alignment.vert_align
-    alignment.wrap = xf.alignment.text_wrapped
-
-    # Create an xlwt pattern
-    pattern = xlwt.Pattern()
-    pattern.pattern = xf.background.fill_pattern
-    pattern.pattern_fore_colour = xf.background.pattern_colour_index
-    pattern.pattern_back_colour = xf.background.background_colour_index
-
-    # Create an xlwt style with the font, borders, alignment, and pattern
-    style = xlwt.XFStyle()
-    style.font = xlwt_font
-    style.borders = borders
-    style.alignment = alignment
-    style.pattern = pattern
-
-    return style
+
+def summarize_details_in_parallel(job, progress):
+    """Summarize every detail workbook of a job on the process pool and merge the results."""
+    processing_logger = job.processing_logger
+    processing_logger.info(f"Summarizing {len(job.large_excels)} detail files in parallel")
+    executor = get_detail_executor()
+    stop_path = worker_stop_path(job)
+    writer = None
+    if job.history_run is not None:
+        writer = RunWriter(history_store.db_path, job.history_run, job.history_dataset, job.period, hospital_rows)
+    futures = [executor.submit(summarize_detail_in_worker, upload.filename, upload.file_path, upload.contents, job.row_log,
+                               stop_path, writer)
+               for upload in job.large_excels]
+    pending = set(futures)
+    while pending:
+        if job.stop_event.is_set():
+            stop_detail_workers(job, futures, stop_path)
+            processing_logger.warning("Processing stopped by user during summarization.")
+            return None
+        done, pending = wait(pending, timeout=CANCEL_POLL_SECONDS, return_when=FIRST_COMPLETED)
+        progress(final=not pending, files=len(futures), files_done=len(futures) - len(pending))
+
+    partials = []
+    for upload, future in zip(job.large_excels, futures):
+        try:
+            summarized_data, records, timings, worker_writer = future.result()
+        except BrokenProcessPool:
+            get_detail_executor(discard_broken=executor)
+            raise
+        # Stage times of the workers add up, though they ran side by side
+        job.timings.merge(timings)
+        for level, message in records:
+            processing_logger.log(level, f"[{upload.filename}] {message}")
+        if summarized_data is None:
+            return None
+        if worker_writer is not None and worker_writer.error is not None and job.history_run is not None:
+            processing_logger.warning(f"Could not record the job in the history: {worker_writer.error}")
+            discard_history_run(job)
+        partials.append(summarized_data)
+    return merge_summaries(partials)
+
+def stop_detail_workers(job, futures, stop_path):
+    """Cancel the queued workbooks of a job and stop the running ones.
+
+    Waits for the running workers, so the pool is free for the next job when
+    this returns, and keeps the stage times and rows they got through.
+    """
+    for future in futures:
+        future.cancel()
+    with open(stop_path, 'w'):
+        pass
+    try:
+        wait(futures)
+        for future in futures:
+            if not future.cancelled() and future.exception() is None:
+                job.timings.merge(future.result()[2])
+    finally:
+        os.remove(stop_path)
+
+def detail_record_hash(record):
+    normalized = [normalize_detail_value(value) for value in record]
+    return hashlib.blake2b(json.dumps(normalized, ensure_ascii=False, default=str).encode('utf-8'), digest_size=16).hexdigest()
+
+def summarize_incremental(job, progress):
+    """Summarize the detail workbooks of a job against the last upload of its dataset.
+
+    Hospitals are keyed by '医疗机构名称' (repeated names get a "#n" suffix).
+    Only the rows that were added or changed since the last upload are
+    aggregated; the stored per-category totals are corrected by their
+    contribution and by that of the removed hospitals.
+    """
+    processing_logger = job.processing_logger
+    dataset_lock = incremental_store.dataset_lock(job.dataset)
+    # Held until the job ends (see finish_incremental_changes), so the next
+    # upload of the dataset, in any worker process, reads the hospitals this one stores
+    if not dataset_lock.acquire(job.stop_event, DATASET_LOCK_TIMEOUT_SECONDS, CANCEL_POLL_SECONDS):
+        if job.stop_event.is_set():
+            processing_logger.warning("Processing stopped by user while waiting for the dataset.")
+        else:
+            processing_logger.error(f"Dataset {job.dataset} is still being updated by another upload, please retry later.")
+        return None
+    job.dataset_lock = dataset_lock
+    known_hashes = incremental_store.load_hashes(job.dataset)
+    seen = set()
+    changed = []  # (hospital key, record hash, record) of added and changed rows
+    history_batch = []  # Every record, for history_store
+    rows_processed = 0
+    for upload in job.large_excels:
+        with job.timings.stage('parse'):
+            large_rows = read_excel_rows(upload.file_path, processing_logger, job.stop_event, file_contents=upload.contents)
+        if large_rows is None:
+            return None
+        try:
+            with job.timings.stage('parse'):
+                large_header = list(itertools.islice(large_rows, SCHEMA_PROBE_ROWS))
+            with job.timings.stage('validate'):
+                schema = validate_large_data(upload.filename, large_header, processing_logger)
+            columns = schema.column_list()
+            large_rows.max_col = max(columns) + 1
+            # Reading and hashing every row; only the changed ones get summarized
+            with job.timings.stage('parse'):
+                for record in iter_detail_records(itertools.chain(large_header, large_rows), columns):
+                    if job.stop_event.is_set():
+                        processing_logger.warning("Processing stopped by user during summarization.")
+                        return None
+                    name = record[0].strip()
+                    hospital_key, n = name, 1
+                    while hospital_key in seen:
+                        n += 1
+                        hospital_key = f"{name}#{n}"
+                    seen.add(hospital_key)
+                    record_hash = detail_record_hash(record)
+                    if known_hashes.get(hospital_key) != record_hash:
+                        changed.append((hospital_key, record_hash, record))
+                    rows_processed += 1
+                    progress(rows=rows_processed, changed=len(changed))
+                    history_batch.append(record)
+                    if len(history_batch) >= ON_BATCH_ROWS:
+                        with job.timings.stage('history'):
+                            record_hospitals(job, history_batch)
+                        history_batch = []
+        except ProcessingStopped:
+            processing_logger.warning("Processing stopped by user during file read.")
+            return None
+        finally:
+            large_rows.close()
+            job.timings.rows = rows_processed
+    with job.timings.stage('history'):
+        record_hospitals(job, history_batch)
+
+    with job.timings.stage('summarize'):
+        upserts = []
+        for start in range(0, len(changed), SUMMARY_CHUNK_ROWS):
+            batch = changed[start:start + SUMMARY_CHUNK_ROWS]
+            categories, metric_values = detail_metrics([record for _, _, record in batch])
+            contributions = zip(*(values.tolist() for values in metric_values))
+            for (hospital_key, record_hash, _), category, contribution in zip(batch, categories, contributions):
+                upserts.append((hospital_key, category, record_hash, list(contribution)))
+        removed = sorted(set(known_hashes) - seen)
+        empty_metrics = empty_summary_row()
+        if job.stop_event.is_set():
+            processing_logger.warning("Processing stopped by user before the dataset was updated.")
+            return None
+        # Committed by process_upload once the summary workbook is written
+        job.incremental_changes = incremental_store.begin_changes(job.dataset, upserts, removed, empty_metrics)
+        totals = job.incremental_changes.totals
+
+    job.changes = {
+        'added': [hospital_key for hospital_key, _, _ in changed if hospital_key not in known_hashes],
+        'changed': [hospital_key for hospital_key, _, _ in changed if hospital_key in known_hashes],
+        'removed': removed,
+    }
+    processing_logger.info(f"Summarized {rows_processed} hospital rows incrementally: "
+                           f"{len(job.changes['added'])} added, {len(job.changes['changed'])} changed, "
+                           f"{len(job.changes['removed'])} removed")
+    summary_data = {category: totals.get(category, list(empty_metrics)) for category in SUMMARY_CATEGORY_ROWS}
+    progress(final=True, rows=rows_processed, changed=len(changed), totals=summary_data)
+    return summary_data
+
+def finish_incremental_changes(job):
+    """Drop the incremental_store changes of a job that did not get to commit them, and free its dataset."""
+    job.incremental_changes = None
+    if job.dataset_lock is not None:
+        job.dataset_lock.release()
+        job.dataset_lock = None
+
+
+def process_upload(job):
+    """Run the read, validate, summarize and write steps of a job.
+
+    Returns an error message, or None once the job's output is available.
+    """
+    processing_logger = job.processing_logger
+    stop_event = job.stop_event
+    summary_excel = job.summary_excel
+
+    with job.timings.stage('parse'):
+        summary_data, summary_book, summary_sheet = read_excel(summary_excel.file_path, processing_logger, stop_event,
+                                                               file_contents=summary_excel.contents)
+    if summary_data is None:
+        return 'Error reading summary Excel file or processing stopped.'
+    with job.timings.stage('validate'):
+        summary_schema = validate_summary_data(summary_excel.filename, summary_data, processing_logger)
+
+    # Summarize large Excel data
+    progress = ProgressReporter(job, job.log_channel)
+    begin_history_run(job)
+    if job.dataset is not None:
+        summarized_data = summarize_incremental(job, progress)
+    elif len(job.large_excels) == 1:
+        upload = job.large_excels[0]
+        summarized_data = summarize_detail(upload.filename, upload.file_path, processing_logger, stop_event,
+                                           progress=progress, row_log=job.row_log, file_contents=upload.contents,
+                                           timings=job.timings, on_batch=lambda records: record_hospitals(job, records))
+    else:
+        summarized_data = summarize_details_in_parallel(job, progress)
+    if summarized_data is None:
+        return 'Error reading or summarizing large Excel data or processing stopped.'
+
+    with job.timings.stage('write_back'):
+        if stop_event.is_set():
+            processing_logger.warning("Processing stopped by user before write-back.")
+            return 'Processing stopped.'
+        output_data = render_summary(summary_excel.filename, summary_book, summary_sheet, summarized_data, summary_schema)
+        if stop_event.is_set():
+            processing_logger.warning("Processing stopped by user during write-back.")
+            return 'Processing stopped.'
+        if job.incremental_changes is not None:
+            job.incremental_changes.commit()
+        job.summary = summarized_data
+        # Incremental results depend on the stored dataset, not only on the uploads,
+        # so they are stored under a key no upload looks up. Going through the cache
+        # directory still lets every worker process serve the download.
+        cache_key = job.cache_key or hashlib.sha256(f"incremental-{job.id}".encode('utf-8')).hexdigest()
+        try:
+            entry = result_cache.put(cache_key, summarized_data, output_data, os.path.splitext(summary_excel.filename)[1])
+            if os.path.exists(entry.output_path):
+                job.output_path = entry.output_path
+                return None
+        except OSError as e:
+            processing_logger.warning(f"Could not cache the result: {e}")
+        job.output_data = output_data
+    return None
+
+def run_job(job):
+    processing_logger = job.processing_logger
+    try:
+        with jobs_lock:
+            if job.stop_event.is_set():
+                job.status = 'cancelled'
+                return
+            job.status = 'running'
+            job.started = time.time()
+        job.publish()
+        error_message = process_upload(job)
+        with jobs_lock:
+            if error_message is None:
+                job.status = 'done'
+            else:
+                job.status = 'cancelled' if job.stop_event.is_set() else 'failed'
+                job.error = error_message
+    except Exception as e:
+        error_message = str(e)
+        stack_trace = traceback.format_exc()
+        processing_logger.error(f"Error: {error_message}")
+        processing_logger.error(f"Stack trace:\n{stack_trace}")
+        with jobs_lock:
+            job.status = 'failed'
+            job.error = error_message
+            job.stack_trace = stack_trace
+    finally:
+        discard_uploads(job)
+        finish_incremental_changes(job)
+        finish_history_run(job)
+        job.finished = job.finished or time.time()
+        job.publish()
+        job.log_channel.end_job(job)
+        job_slots.release()
+        record_job_metrics(job)
 
 @app.route('/upload', methods=['POST'])
 def upload_files():
     try:
-        session_id = get_session_id()
-        stop_event = get_stop_event(session_id)
-        processing_logger = get_logger(session_id)
-        stop_event.clear()
-        log_streams[session_id].truncate(0)
-        log_streams[session_id].seek(0)
+        session_state = sessions.get(get_session_id())
+        processing_logger = session_state.processing_logger
+        session_state.log_channel.clear()
 
-        large_excel = request.files.get('large_excel')
+        # Several detail workbooks (one per city) may be uploaded at once
+        large_excels = [f for f in request.files.getlist('large_excel') if f]
         summary_excel = request.files.get('summary_excel')
 
-        if not large_excel or not summary_excel:
+        if not large_excels or not summary_excel:
             processing_logger.error("Both files are required.")
             return jsonify({'error': 'Both files are required.'}), 400
 
-        if not allowed_file(large_excel.filename) or not allowed_file(summary_excel.filename):
+        if not all(allowed_file(f.filename) for f in large_excels) or not allowed_file(summary_excel.filename):
             processing_logger.error("Both files must be in Excel format (.xls or .xlsx).")
             return jsonify({'error': 'Both files must be in Excel format (.xls or .xlsx).'}), 400
 
-        large_excel_path = os.path.join(UPLOAD_FOLDER, large_excel.filename)
-        summary_excel_path = os.path.join(UPLOAD_FOLDER, summary_excel.filename)
-        large_excel.save(large_excel_path)
-        summary_excel.save(summary_excel_path)
+        period = request.form.get('period', '').strip() or time.strftime('%Y-%m')
+        if not PERIOD_PATTERN.match(period):
+            processing_logger.error(f"The reporting period must be given as YYYY-MM, not {period}.")
+            return jsonify({'error': f"The reporting period must be given as YYYY-MM, not {period}."}), 400
 
-        # Process each file individually
-        large_data, large_book, large_sheet = read_excel(large_excel_path, processing_logger, stop_event)
-        if large_data is None:
-            return jsonify({'error': 'Error reading large Excel file or processing stopped.'}), 400
-        validate_large_data(large_excel.filename, large_data, processing_logger)
+        if not job_slots.acquire(blocking=False):
+            processing_logger.error("Too many jobs queued, please retry later.")
+            return jsonify({'error': 'Too many jobs queued, please retry later.'}), 503
 
-        summary_data, summary_book, summary_sheet = read_excel(summary_excel_path, processing_logger, stop_event)
-        if summary_data is None:
-            return jsonify({'error': 'Error reading summary Excel file or processing stopped.'}), 400
-        validate_summary_data(summary_excel.filename, summary_data, processing_logger)
+        job = Job(session_state)
+        job.row_log = request.form.get('row_log') == '1'
+        job.history_dataset = request.form.get('dataset', '').strip() or 'default'
+        job.period = period
+        if request.form.get('incremental') == '1':
+            job.dataset = job.history_dataset
+        try:
+            with job.timings.stage('upload'):
+                job.large_excels = [SpooledUpload(large_excel, job.id) for large_excel in large_excels]
+                job.summary_excel = SpooledUpload(summary_excel, job.id)
+            job.input_bytes = sum(upload.size for upload in job.large_excels + [job.summary_excel])
 
-        # Summarize large Excel data
-        summarized_data = summarize_large_data(large_data, processing_logger, stop_event)
-        if summarized_data is None:
-            return jsonify({'error': 'Error summarizing large Excel data or processing stopped.'}), 400
-
-        # Write the summarized data to the summary Excel file, preserving the format
-        output_path = summary_excel_path  # Preserve the same file name and path
-
-        if summary_excel.filename.endswith('.xlsx'):
-            summary_sheet = summary_book.active
-            # If the first column data value of summary_sheet is in summarized_data, use summarized_data instead
-            for row in summary_sheet.iter_rows():
-                if row[0].value in summarized_data:
-                    key = row[0].value
-                    row_data = summarized_data[key]
-                    for col_idx, value in enumerate(row_data):
-                        row[col_idx].value = value
-            summary_book.save(output_path)
+            cached = None
+            if job.dataset is None:
+                job.cache_key = result_cache_key(job)
+                cached = result_cache.get(job.cache_key)
+            schema_error = None
+            if cached is None:
+                with job.timings.stage('validate'):
+                    schema_error = check_upload_schemas(job)
+            if schema_error is not None:
+                job_slots.release()
+                discard_uploads(job)
+                processing_logger.error(schema_error)
+                return jsonify({'error': schema_error}), 400
+            with jobs_lock:
+                jobs[job.id] = job
+                if cached is not None:
+                    job.status = 'done'
+                    job.cache_hit = True
+                    job.summary = cached.summary
+                    job.output_path = cached.output_path
+                    job.finished = time.time()
+            job.publish()
+            if cached is None:
+                job_executor.submit(run_job, job)
+        except BaseException:
+            job_slots.release()
+            discard_uploads(job)
+            raise
+
+        if job.cache_hit:
+            job_slots.release()
+            job_executor.submit(record_cached_history, job)
+            discard_uploads(job)
+            record_job_metrics(job)
+            processing_logger.info(f"Job {job.id} served from the result cache.")
+            job.log_channel.end_job(job)
         else:
-            wb = xl_copy(summary_book)
-            ws = wb.get_sheet(0)
-            # write 三级甲等医院 data to summary sheet
-            for idx, value in enumerate(summarized_data["三级甲等医院"], 1):
-                style = get_xlwt_style(summary_book, summary_sheet, 4, 0)
-                ws.write(4, idx, value, style)
-            # write 三级公立医院 data to summary sheet
-            for idx, value in enumerate(summarized_data["三级公立医院"], 1):
-                style = get_xlwt_style(summary_book, summary_sheet, 5, 0)
-                ws.write(5, idx, value, style)
-            for idx, value in enumerate(summarized_data["三级民营医院"], 1):
-                style = get_xlwt_style(summary_book, summary_sheet, 6, 0)
-                ws.write(6, idx, value, style)
-            # write 二级公立医院 data to summary sheet
-            for idx, value in enumerate(summarized_data["二级公立医院"], 1):
-                style = get_xlwt_style(summary_book, summary_sheet, 7, 0)
-                ws.write(7, idx, value, style)
-            # write 二级民营医院 data to summary sheet
-            for idx, value in enumerate(summarized_data["二级民营医院"], 1):
-                style = get_xlwt_style(summary_book, summary_sheet, 8, 0)
-                ws.write(8, idx, value, style)
-            wb.save(output_path)
-
-        # Clean up uploaded files
-        os.remove(large_excel_path)
-        response = send_file(output_path, as_attachment=True, attachment_filename=summary_excel.filename)
+            processing_logger.info(f"Job {job.id} queued.")
+        response = jsonify(job.to_dict())
         response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
         response.headers['Pragma'] = 'no-cache'
         response.headers['Expires'] = '0'
-        time.sleep(5)
-        return response
+        return response, 202
     except Exception as e:
         session_id = get_session_id()
         processing_logger = get_logger(session_id)
@@ -538,29 +1038,188 @@ def upload_files():
         processing_logger.error(f"Stack trace:\n{stack_trace}")
         return jsonify({'error': error_message, 'stack_trace': stack_trace}), 500
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    record = get_job_record(get_session_id(), job_id)
+    if record is None:
+        return jsonify({'error': 'Job not found.'}), 404
+    response = jsonify(record['state'])
+    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+    response.headers['Pragma'] = 'no-cache'
+    response.headers['Expires'] = '0'
+    return response
+
+def call_after_sending(response, callback):
+    """Call callback once the server has sent the body of a send_file response.
+
+    send_file responses are passed straight through to the server, which may
+    use sendfile(), so call_on_close never runs for them; the server does close
+    the file wrapper once the body is out.
+    """
+    if not response.direct_passthrough:
+        response.call_on_close(callback)
+        return
+    file_wrapper = response.response
+    close = file_wrapper.close
+
+    def close_and_call():
+        try:
+            close()
+        finally:
+            callback()
+    file_wrapper.close = close_and_call
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    started = time.perf_counter()
+    record = get_job_record(get_session_id(), job_id)
+    if record is None:
+        return jsonify({'error': 'Job not found.'}), 404
+    state = record['state']
+    if state['status'] != 'done':
+        return jsonify({'error': f"Job is {state['status']}."}), 409
+    # Results are files in the result cache, which are never rewritten in place:
+    # they are streamed from disk with their length, ETag and Last-Modified,
+    # and Range and conditional requests are honoured. Only the process that
+    # ran the job holds a result it could not cache.
+    job = jobs.get(job_id)
+    if job is not None and job.output_data is not None:
+        output = io.BytesIO(job.output_data)
+    elif record['output_path'] and os.path.exists(record['output_path']):
+        output = record['output_path']
+    else:
+        return jsonify({'error': 'Result has expired, please upload again.'}), 410
+    response = send_file(output, as_attachment=True, attachment_filename=record['output_name'],
+                         conditional=True, cache_timeout=0)
+
+    def record_send():
+        try:
+            shared_state.observe([metrics.observation('lingling_stage_seconds', time.perf_counter() - started, stage='send')])
+        except Exception:
+            app.logger.exception("Recording the send time of a result failed")
+    call_after_sending(response, record_send)
+    response.headers['X-Cache'] = 'HIT' if state['cache_hit'] else 'MISS'
+    # Revalidated on every use rather than never stored, so resumed and
+    # repeated downloads can be conditional
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 @app.route('/stop', methods=['POST'])
 def stop_processing():
     session_id = get_session_id()
-    stop_event = get_stop_event(session_id)
     processing_logger = get_logger(session_id)
-    stop_event.set()
+    cancelled = cancel_session_jobs(session_id)
     processing_logger.info("Processing stopped by user.")
-    response = jsonify({'message': 'Processing stopped'})
+    response = jsonify({'message': 'Processing stopped', 'cancelled_jobs': cancelled})
+    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+    response.headers['Pragma'] = 'no-cache'
+    response.headers['Expires'] = '0'
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    job_counts = shared_state.job_counts()
+    session_gauges = sessions.gauges()
+    process_gauges = shared_state.process_gauges(process_alive)
+    gauges = [
+        ('lingling_job_queue_depth', "Jobs waiting for a job worker, over all processes", job_counts.get('queued', 0)),
+        ('lingling_jobs_running', "Jobs being processed, over all processes", job_counts.get('running', 0)),
+        ('lingling_sessions', "Browser sessions with logs or jobs", session_gauges['sessions']),
+        ('lingling_session_log_bytes', "Log text held for the sessions", session_gauges['bytes']),
+        ('lingling_sse_connections', "Open /logs streams, over all processes", int(process_gauges.get('sse_connections', 0))),
+    ]
+    response = Response(metrics.render(shared_state.histograms(), gauges), mimetype='text/plain; version=0.0.4')
+    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+    return response
+
+def history_query():
+    """Dataset and inclusive period range of a /history request, from dataset, period or start and end.
+
+    Raises ValueError for a period not given as YYYY-MM.
+    """
+    dataset = request.args.get('dataset', '').strip() or 'default'
+    period = request.args.get('period') or None
+    start = request.args.get('start') or period
+    end = request.args.get('end') or period
+    for value in (start, end):
+        if value is not None and not PERIOD_PATTERN.match(value):
+            raise ValueError(f"Periods must be given as YYYY-MM, not {value}.")
+    return dataset, start, end
+
+def history_response(payload):
+    response = jsonify(payload)
     response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
     return response
 
+@app.route('/history/runs')
+def history_runs():
+    try:
+        dataset, start, end = history_query()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return history_response({'dataset': dataset, 'runs': history_store.runs(dataset, start, end)})
+
+@app.route('/history/categories')
+def history_categories():
+    """Category totals per period: categories -> metric -> period -> value."""
+    try:
+        dataset, start, end = history_query()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    rows = history_store.category_metrics(dataset, start, end, categories=request.args.getlist('category'),
+                                          metrics=request.args.getlist('metric'))
+    categories = {}
+    for period, category, metric, value in rows:
+        categories.setdefault(category, {}).setdefault(metric, {})[period] = value
+    periods = sorted({period for period, _, _, _ in rows})
+    return history_response({'dataset': dataset, 'periods': periods, 'categories': categories})
+
+@app.route('/history/trend')
+def history_trend():
+    """One metric per period, added up over the given categories (all by default), with its change."""
+    try:
+        dataset, start, end = history_query()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    metric = request.args.get('metric')
+    if metric not in list(summary_data_field_dic.values())[1:]:
+        return jsonify({'error': f"Unknown metric {metric}."}), 400
+    categories = request.args.getlist('category')
+    totals = {}
+    for period, _, _, value in history_store.category_metrics(dataset, start, end, categories=categories,
+                                                              metrics=[metric]):
+        totals[period] = totals.get(period, 0) + value
+    points, previous = [], None
+    for period in sorted(totals):
+        value = totals[period]
+        change = value - previous if previous is not None else None
+        points.append({'period': period, 'value': value, 'change': change,
+                       'change_ratio': round(change / previous, 6) if change is not None and previous else None})
+        previous = value
+    return history_response({'dataset': dataset, 'metric': metric, 'categories': categories or None, 'points': points})
+
+@app.route('/history/hospitals')
+def history_hospitals():
+    """Stored rows of the hospitals of a period range, optionally of one name or category."""
+    try:
+        dataset, start, end = history_query()
+        limit = max(1, min(int(request.args.get('limit', 1000)), HISTORY_MAX_HOSPITALS))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    hospitals = history_store.hospitals(dataset, start, end, name=request.args.get('name'),
+                                        category=request.args.get('category'), limit=limit)
+    return history_response({'dataset': dataset, 'hospitals': hospitals, 'truncated': len(hospitals) == limit})
+
 @app.route('/clear_logs', methods=['POST'])
 def clear_logs():
-    session_id = get_session_id()
-    if session_id in log_streams:
-        log_streams[session_id].truncate(0)
-        log_streams[session_id].seek(0)
+    sessions.get(get_session_id()).log_channel.clear()
     return jsonify({'message': 'Logs cleared'})
 
 if __name__ == '__main__':
     # Disable Flask's default logging
     # log = logging.getLogger('werkzeug')
     # log.setLevel(logging.ERROR)
-    app.run(debug=True, host='0.0.0.0', port=8000)
+    # Development server only; production runs under gunicorn, see gunicorn.conf.py
+    app.run(debug=os.environ.get('LINGLING_DEBUG') == '1', host='0.0.0.0', port=8000, threaded=True)
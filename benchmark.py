@@ -0,0 +1,297 @@
+#!/usr/bin/env python3.8
+"""Benchmark the summarizing pipeline on synthetic workbooks.
+
+    python3.8 benchmark.py --rows 1000 10000 100000 --output bench.json
+
+For every format and row count a detail workbook following the
+large_data_field_dic layout (title rows, header, "总计" row, hospitals, "注"
+row) and a summary template are generated into --work-dir, once. Each case
+then runs in a fresh process, which times the stages of the pipeline
+separately and records the peak RSS after each of them:
+
+* read_excel, validate_large_data, get_one_row_data, summarize_large_data and
+  the openpyxl/xlwt write-back (render_summary), on the fully loaded sheet;
+* summarize_detail, the streaming path the web app and cli.py use, in a
+  process of its own so its peak RSS is not hidden by the full load;
+* read_excel_rows alone, the values-only reader of that path, also in a
+  process of its own, to set against read_excel.
+
+The results are written as JSON. With --compare the stage times are also
+checked against the results of an earlier run, e.g. of the previous version.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from threading import Event
+
+from summarizer import (SUMMARY_CATEGORY_ROWS, large_data_field_dic, summary_data_field_dic, read_excel,
+                        read_excel_rows, validate_large_data, validate_summary_data, get_one_row_data, summarize_large_data,
+                        summarize_detail, render_summary)
+
+FORMATS = ('xlsx', 'xls')
+DEFAULT_ROWS = (1000, 10000, 100000, 500000)
+XLS_MAX_ROWS = 65536  # Rows per sheet in the .xls format
+REGRESSION_THRESHOLD = 1.2  # Stage time ratio against --compare reported as a regression
+
+logger = logging.getLogger('lingling.benchmark')
+
+
+def detail_rows(n, seed=0):
+    """Rows of a synthetic detail sheet with n hospitals."""
+    rnd = random.Random(seed)
+    categories = list(SUMMARY_CATEGORY_ROWS)
+    width = len(large_data_field_dic)
+    yield ["检查检验结果互认工作统计表"]
+    yield ["填报单位：基准测试"]
+    yield [large_data_field_dic[idx] for idx in range(width)] + ["总项目", "总费用"]
+    yield ["总计"]
+    for i in range(n):
+        yield [
+            f"医院{i}", categories[rnd.randrange(len(categories))], rnd.choice([0, 1]), rnd.randrange(30),
+            rnd.choice([0, 1, "/"]), rnd.choice([rnd.randrange(30), "/", None]), rnd.choice([0, 1]), rnd.choice([0, 1]),
+            rnd.randrange(50), round(rnd.random() * 1000, 2), rnd.randrange(50), round(rnd.random() * 1000, 2),
+            rnd.randrange(50), rnd.choice([round(rnd.random() * 1000, 2), "/"]), rnd.randrange(50),
+            round(rnd.random() * 1000, 2), rnd.randrange(100), 0, 0,
+        ]
+    yield ["注：以上数据为基准测试生成"]
+
+
+def summary_rows():
+    """Rows of a summary template in the standard layout."""
+    rows = [["检查检验结果互认工作汇总表"], [], [], [summary_data_field_dic[idx] for idx in range(len(summary_data_field_dic))]]
+    for category, row in SUMMARY_CATEGORY_ROWS.items():
+        rows.extend([] for _ in range(row - len(rows)))
+        rows.append([category])
+    return rows
+
+
+def write_workbook(path, rows):
+    if path.endswith('.xlsx'):
+        import openpyxl
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet()
+        for row in rows:
+            ws.append(row)
+        wb.save(path)
+    else:
+        import xlwt
+        wb = xlwt.Workbook()
+        ws = wb.add_sheet("Sheet1")
+        style = xlwt.easyxf("borders: left thin, right thin, top thin, bottom thin")
+        for rowx, row in enumerate(rows):
+            for colx, value in enumerate(row):
+                if value is not None:
+                    ws.write(rowx, colx, value, style)
+        wb.save(path)
+
+
+def ensure_workbooks(work_dir, fmt, rows, seed):
+    """Generate the detail workbook and summary template of a case unless they exist; returns their paths."""
+    os.makedirs(work_dir, exist_ok=True)
+    detail_path = os.path.join(work_dir, f"detail-{rows}-{seed}.{fmt}")
+    summary_path = os.path.join(work_dir, f"summary.{fmt}")
+    for path, make_rows in ((detail_path, lambda: detail_rows(rows, seed)), (summary_path, summary_rows)):
+        if not os.path.exists(path):
+            started = time.monotonic()
+            # Written under a temporary name, so an interrupted run leaves no truncated workbook behind
+            partial_path = path + '.partial.' + fmt
+            write_workbook(partial_path, make_rows())
+            os.replace(partial_path, path)
+            logger.info(f"Generated {path} in {time.monotonic() - started:.1f}s")
+    return detail_path, summary_path
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    def run(self, name, work):
+        started = time.perf_counter()
+        result = work()
+        self.stages[name] = {'seconds': round(time.perf_counter() - started, 4), 'peak_rss_mb': peak_rss_mb()}
+        return result
+
+
+def run_full_stages(detail_path, summary_path):
+    """Time the pipeline stage by stage on the fully loaded detail sheet. Runs in a worker process."""
+    quiet = logging.Logger('benchmark', logging.WARNING)
+    file_name = os.path.basename(detail_path)
+    baseline = peak_rss_mb()
+    timer = StageTimer()
+    large_data, _, _ = timer.run('read_excel', lambda: read_excel(detail_path, quiet, Event()))
+    if large_data is None:
+        raise ValueError(f"Could not read {detail_path}")
+    schema = timer.run('validate_large_data', lambda: validate_large_data(file_name, large_data, quiet))
+    rows = timer.run('get_one_row_data', lambda: sum(1 for _ in get_one_row_data(large_data)))
+    summarized_data = timer.run('summarize_large_data', lambda: summarize_large_data(
+        large_data, quiet, Event(), columns=schema.column_list()))
+
+    summary_data, summary_book, summary_sheet = read_excel(summary_path, quiet, Event())
+    summary_schema = validate_summary_data(os.path.basename(summary_path), summary_data, quiet)
+    output = timer.run('write_back', lambda: render_summary(
+        summary_path, summary_book, summary_sheet, summarized_data, summary_schema))
+    return {'rows': rows, 'baseline_rss_mb': baseline, 'stages': timer.stages, 'output_bytes': len(output)}
+
+
+def run_streaming(detail_path):
+    """Time summarize_detail, the streaming read and summarize path. Runs in a worker process."""
+    quiet = logging.Logger('benchmark', logging.WARNING)
+    baseline = peak_rss_mb()
+    timer = StageTimer()
+    summarized_data = timer.run('summarize_detail', lambda: summarize_detail(
+        os.path.basename(detail_path), detail_path, quiet, Event()))
+    if summarized_data is None:
+        raise ValueError(f"Could not read {detail_path}")
+    return {'baseline_rss_mb': baseline, 'stages': timer.stages}
+
+
+def run_row_read(detail_path):
+    """Time read_excel_rows over the whole detail sheet, cut at the detail columns. Runs in a worker process."""
+    quiet = logging.Logger('benchmark', logging.WARNING)
+    timer = StageTimer()
+
+    def read_rows():
+        rows = read_excel_rows(detail_path, quiet, Event())
+        if rows is None:
+            raise ValueError(f"Could not read {detail_path}")
+        rows.max_col = len(large_data_field_dic)
+        try:
+            return sum(1 for _ in rows)
+        finally:
+            rows.close()
+
+    timer.run('read_excel_rows', read_rows)
+    return {'stages': timer.stages}
+
+
+def in_fresh_process(function, *args):
+    """Call function in a new process, so its peak RSS is its own."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+
+def run_case(work_dir, fmt, rows, seed, repeat):
+    """Benchmark one format and row count; stage times are the best of repeat runs."""
+    case = {'format': fmt, 'rows': rows, 'status': 'done', 'error': None}
+    if fmt == 'xls' and rows + 10 > XLS_MAX_ROWS:
+        case.update(status='skipped', error=f".xls sheets hold at most {XLS_MAX_ROWS} rows")
+        return case
+    try:
+        detail_path, summary_path = ensure_workbooks(work_dir, fmt, rows, seed)
+        case['detail_bytes'] = os.path.getsize(detail_path)
+        runs = []
+        for _ in range(repeat):
+            full = in_fresh_process(run_full_stages, detail_path, summary_path)
+            streaming = in_fresh_process(run_streaming, detail_path)
+            row_read = in_fresh_process(run_row_read, detail_path)
+            runs.append({**full['stages'], **streaming['stages'], **row_read['stages']})
+        case['baseline_rss_mb'] = full['baseline_rss_mb']
+        case['stages'] = {name: min((run[name] for run in runs), key=lambda stage: stage['seconds']) for name in runs[0]}
+        case['peak_rss_mb'] = {'full': max(stage['peak_rss_mb'] for name, stage in runs[-1].items()
+                                           if name not in ('summarize_detail', 'read_excel_rows')),
+                               'streaming': runs[-1]['summarize_detail']['peak_rss_mb'],
+                               'row_read': runs[-1]['read_excel_rows']['peak_rss_mb']}
+        seconds = case['stages']['summarize_detail']['seconds']
+        case['streaming_rows_per_second'] = round(rows / seconds) if seconds else None
+    except Exception as e:
+        logger.error(f"Error: {fmt} {rows} rows: {e}")
+        case.update(status='failed', error=str(e))
+    return case
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    """Stage time ratios of results against an earlier run, for the cases and stages both have."""
+    earlier = {(case['format'], case['rows']): case for case in previous['cases'] if case['status'] == 'done'}
+    comparison = []
+    for case in results['cases']:
+        before = earlier.get((case['format'], case['rows']))
+        if case['status'] != 'done' or before is None:
+            continue
+        for name, stage in case['stages'].items():
+            if name not in before['stages'] or not before['stages'][name]['seconds']:
+                continue
+            ratio = stage['seconds'] / before['stages'][name]['seconds']
+            comparison.append({'format': case['format'], 'rows': case['rows'], 'stage': name,
+                               'seconds': stage['seconds'], 'previous_seconds': before['stages'][name]['seconds'],
+                               'ratio': round(ratio, 3), 'regression': ratio > REGRESSION_THRESHOLD})
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the summarizing pipeline on synthetic workbooks.")
+    parser.add_argument('--rows', type=int, nargs='+', default=list(DEFAULT_ROWS),
+                        help="hospital rows of the generated detail workbooks (default: %(default)s)")
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=list(FORMATS), help="workbook formats to benchmark")
+    parser.add_argument('-w', '--work-dir', default='benchmark', help="directory of the generated workbooks (default: benchmark)")
+    parser.add_argument('-o', '--output', help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per case, the fastest one counts (default: 1)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed of the generated rows")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare the stage times with")
+    parser.add_argument('-q', '--quiet', action='store_true', help="only log warnings and errors")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s', stream=sys.stderr)
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'started': time.time(),
+        'cases': [],
+    }
+    for fmt in args.formats:
+        for rows in sorted(args.rows):
+            logger.info(f"Benchmarking {rows} rows of .{fmt}")
+            case = run_case(args.work_dir, fmt, rows, args.seed, max(args.repeat, 1))
+            if case['status'] == 'done':
+                logger.info(", ".join(f"{name} {stage['seconds']}s" for name, stage in case['stages'].items())
+                            + f", peak RSS {case['peak_rss_mb']['full']} MB full / {case['peak_rss_mb']['streaming']} MB streaming")
+            elif case['status'] == 'skipped':
+                logger.info(f"Skipped: {case['error']}")
+            results['cases'].append(case)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            results['comparison'] = compare(results, json.load(f))
+        for entry in results['comparison']:
+            if entry['regression']:
+                logger.warning(f"Regression: {entry['stage']} on {entry['rows']} rows of .{entry['format']} took "
+                               f"{entry['seconds']}s, {entry['ratio']}x the previous {entry['previous_seconds']}s")
+
+    results_json = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(results_json + '\n')
+    else:
+        print(results_json)
+    failed = [case for case in results['cases'] if case['status'] == 'failed']
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
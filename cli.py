@@ -0,0 +1,192 @@
+#!/usr/bin/env python3.8
+"""Summarize detail workbooks from the command line, without the web app.
+
+    python3.8 cli.py --summary 汇总表.xls --output-dir out details/*.xlsx
+
+Every detail workbook is summarized into its own copy of the summary
+template, several workbooks in parallel. With --merge all detail workbooks are
+also added up into one summary. A JSON report of the run is written to
+--report, or to stdout.
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from threading import Event
+
+from summarizer import RecordingHandler, read_excel, validate_summary_data, summarize_detail, merge_summaries, render_summary
+
+EXCEL_EXTENSIONS = ('.xls', '.xlsx')
+
+logger = logging.getLogger('lingling')
+
+
+def find_detail_files(paths):
+    """Expand directories and glob patterns into the detail workbooks they contain, in order."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = sorted(os.path.join(path, name) for name in os.listdir(path))
+        else:
+            candidates = sorted(glob.glob(path)) or [path]
+        for candidate in candidates:
+            # ~$ files are Office lock files, not workbooks
+            if candidate.lower().endswith(EXCEL_EXTENSIONS) and not os.path.basename(candidate).startswith('~$'):
+                files.append(candidate)
+    return list(dict.fromkeys(files))
+
+
+def output_paths(detail_files, summary_path, output_dir):
+    """Output file of each detail workbook: <detail name>-<summary name> in output_dir."""
+    summary_name = os.path.basename(summary_path)
+    paths, used = [], set()
+    for detail_path in detail_files:
+        detail_name = os.path.splitext(os.path.basename(detail_path))[0]
+        path, n = os.path.join(output_dir, f"{detail_name}-{summary_name}"), 1
+        while path in used:
+            n += 1
+            path = os.path.join(output_dir, f"{detail_name}-{n}-{summary_name}")
+        used.add(path)
+        paths.append(path)
+    return paths
+
+
+def load_summary_template(summary_path, processing_logger):
+    """Read and validate the summary template; returns (workbook, sheet, schema)."""
+    summary_data, summary_book, summary_sheet = read_excel(summary_path, processing_logger, Event())
+    if summary_data is None:
+        raise ValueError(f"Could not read the summary template {summary_path}")
+    schema = validate_summary_data(os.path.basename(summary_path), summary_data, processing_logger)
+    return summary_book, summary_sheet, schema
+
+
+def write_summary(summary_path, summarized_data, output_path, processing_logger):
+    summary_book, summary_sheet, schema = load_summary_template(summary_path, processing_logger)
+    output_data = render_summary(summary_path, summary_book, summary_sheet, summarized_data, schema)
+    with open(output_path, 'wb') as f:
+        f.write(output_data)
+    processing_logger.info(f"Wrote {output_path}")
+
+
+def process_detail(detail_path, summary_path, output_path, row_log=False):
+    """Summarize one detail workbook into its own copy of the summary template.
+
+    Runs in a worker process; returns the report entry of the workbook and the
+    log records to replay in the main process.
+    """
+    started = time.monotonic()
+    file_name = os.path.basename(detail_path)
+    processing_logger = logging.Logger(file_name, logging.INFO)
+    handler = RecordingHandler()
+    processing_logger.addHandler(handler)
+    entry = {'detail': detail_path, 'status': 'failed', 'output': None, 'error': None, 'summary': None}
+    try:
+        summarized_data = summarize_detail(file_name, detail_path, processing_logger, Event(), row_log=row_log)
+        if summarized_data is None:
+            raise ValueError("Error reading large Excel data.")
+        write_summary(summary_path, summarized_data, output_path, processing_logger)
+        entry.update(status='done', output=output_path, summary=summarized_data)
+    except Exception as e:
+        processing_logger.error(f"Error: {e}")
+        entry['error'] = str(e)
+    entry['seconds'] = round(time.monotonic() - started, 3)
+    return entry, handler.records
+
+
+def run(detail_files, summary_path, output_dir, workers, merge=False, row_log=False):
+    """Process every detail workbook and return the report of the run."""
+    started = time.time()
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = output_paths(detail_files, summary_path, output_dir)
+    if workers > 1 and len(detail_files) > 1:
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(detail_files)))
+        results = executor.map(process_detail, detail_files, [summary_path] * len(detail_files), outputs,
+                               [row_log] * len(detail_files))
+    else:
+        executor = None
+        results = (process_detail(detail_path, summary_path, output_path, row_log)
+                   for detail_path, output_path in zip(detail_files, outputs))
+
+    entries = []
+    try:
+        for entry, records in results:
+            for level, message in records:
+                logger.log(level, f"[{os.path.basename(entry['detail'])}] {message}")
+            entries.append(entry)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    failed = [entry['detail'] for entry in entries if entry['status'] != 'done']
+    merged = None
+    if merge:
+        merged = {'status': 'failed', 'output': None, 'error': None, 'summary': None}
+        if failed:
+            merged['error'] = f"Not merged, {len(failed)} detail workbooks failed."
+        else:
+            summarized_data = merge_summaries(entry['summary'] for entry in entries)
+            output_path = os.path.join(output_dir, os.path.basename(summary_path))
+            try:
+                write_summary(summary_path, summarized_data, output_path, logger)
+                merged.update(status='done', output=output_path, summary=summarized_data)
+            except Exception as e:
+                logger.error(f"Error: {e}")
+                merged['error'] = str(e)
+        if merged['status'] != 'done':
+            failed.append('merged')
+
+    return {
+        'summary_template': summary_path,
+        'output_dir': output_dir,
+        'workers': workers,
+        'started': started,
+        'seconds': round(time.time() - started, 3),
+        'files': entries,
+        'merged': merged,
+        'failed': failed,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize detail workbooks into copies of a summary template.")
+    parser.add_argument('details', nargs='+', help="detail workbooks, directories or glob patterns")
+    parser.add_argument('-s', '--summary', required=True, help="summary template workbook (.xls or .xlsx)")
+    parser.add_argument('-o', '--output-dir', default='output', help="directory of the filled summaries (default: output)")
+    parser.add_argument('-r', '--report', help="write the JSON report to this file instead of stdout")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1,
+                        help="detail workbooks processed in parallel (default: CPU count)")
+    parser.add_argument('--merge', action='store_true', help="also write one summary of all detail workbooks added up")
+    parser.add_argument('--row-log', action='store_true', help="log every hospital row as JSON")
+    parser.add_argument('-q', '--quiet', action='store_true', help="only log warnings and errors")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s', stream=sys.stderr)
+    detail_files = find_detail_files(args.details)
+    if not detail_files:
+        parser.error("no .xls or .xlsx detail workbooks found")
+    if not args.summary.lower().endswith(EXCEL_EXTENSIONS):
+        parser.error("the summary template must be an .xls or .xlsx file")
+    try:
+        load_summary_template(args.summary, logger)
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        return 2
+
+    report = run(detail_files, args.summary, args.output_dir, max(args.workers, 1), merge=args.merge, row_log=args.row_log)
+    report_json = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            f.write(report_json + '\n')
+    else:
+        print(report_json)
+    logger.info(f"Processed {len(detail_files)} detail workbooks in {report['seconds']}s, {len(report['failed'])} failed")
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
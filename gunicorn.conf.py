@@ -0,0 +1,31 @@
+"""gunicorn settings for serving lingling in production.
+
+    gunicorn -c gunicorn.conf.py
+
+Every worker process runs its own job queue; sessions, logs and job records
+are shared through the SQLite database of shared_state.py, so requests of one
+browser may be served by any worker.
+"""
+import os
+
+wsgi_app = 'app:app'
+bind = os.environ.get('LINGLING_BIND', '0.0.0.0:8000')
+
+# Summarizing is CPU bound, so throughput grows with the number of processes
+workers = int(os.environ.get('LINGLING_WEB_WORKERS', os.cpu_count() or 1))
+# gthread: every open /logs stream holds a thread for as long as the page is
+# open, so leave plenty of threads for the short requests next to them
+worker_class = 'gthread'
+threads = int(os.environ.get('LINGLING_WEB_THREADS', 32))
+# gthread workers send their heartbeat from the main thread, so long-lived
+# streams and uploads don't count against the timeout
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# Each worker must import the app itself: the app starts threads and pools at
+# import time, which would not survive the fork of a preloaded master
+preload_app = False
+
+accesslog = '-'
+errorlog = '-'
@@ -0,0 +1,269 @@
+"""SQLite store of every accepted summarization, for queries across reporting periods.
+
+Each run belongs to a dataset and a reporting period ("YYYY-MM"); a run
+accepted for a period replaces the earlier one of that dataset and period.
+The store keeps:
+
+* runs: the accepted runs, with the field names their rows are stored under,
+* hospitals: the normalized detail row of every hospital of a run, indexed by
+  period, category and name,
+* category_metrics: the summary of a run, one value per category and metric,
+  indexed by metric, category and period.
+
+Rows are written while a job is still summarizing, under a pending run that
+only becomes visible once the job is accepted. Detail worker processes write
+theirs through a RunWriter.
+"""
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+PENDING_RUN_MAX_AGE_SECONDS = 24 * 3600  # Pending runs older than this were left by a crashed worker
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    dataset TEXT NOT NULL,
+    period TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    job_id TEXT,
+    cache_key TEXT,
+    files TEXT NOT NULL,
+    hospital_count INTEGER NOT NULL DEFAULT 0,
+    detail_fields TEXT NOT NULL,
+    summary_fields TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_by_period ON runs (dataset, status, period);
+CREATE INDEX IF NOT EXISTS runs_by_cache_key ON runs (cache_key);
+CREATE TABLE IF NOT EXISTS hospitals (
+    run_id TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    period TEXT NOT NULL,
+    name TEXT NOT NULL,
+    category TEXT NOT NULL,
+    row TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hospitals_by_run ON hospitals (run_id);
+CREATE INDEX IF NOT EXISTS hospitals_by_period ON hospitals (dataset, period, category);
+CREATE INDEX IF NOT EXISTS hospitals_by_category ON hospitals (dataset, category, period);
+CREATE INDEX IF NOT EXISTS hospitals_by_name ON hospitals (dataset, name, period);
+CREATE TABLE IF NOT EXISTS category_metrics (
+    run_id TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    period TEXT NOT NULL,
+    category TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value NOT NULL,  -- Untyped, so integer metrics stay integers
+    PRIMARY KEY (run_id, category, metric)
+);
+CREATE INDEX IF NOT EXISTS category_metrics_by_metric ON category_metrics (dataset, metric, category, period);
+"""
+
+
+class HistoryStore:
+    def __init__(self, db_path):
+        self.db_path = os.path.abspath(db_path)
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        with self._schema_lock:
+            if not self._schema_ready:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.executescript(SCHEMA)
+                self._schema_ready = True
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            yield connection
+            connection.execute("COMMIT")
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.close()
+
+    def begin_run(self, dataset, period, job_id, files, detail_fields, summary_fields):
+        """Start a pending run and return its id; pending runs of crashed workers are dropped."""
+        run_id = str(uuid.uuid4())
+        with self._transaction() as connection:
+            stale = [row[0] for row in connection.execute(
+                "SELECT run_id FROM runs WHERE status = 'pending' AND created < ?",
+                (time.time() - PENDING_RUN_MAX_AGE_SECONDS,))]
+            self._delete_runs(connection, stale)
+            connection.execute(
+                "INSERT INTO runs (run_id, dataset, period, status, created, job_id, files, detail_fields, summary_fields) "
+                "VALUES (?, ?, ?, 'pending', ?, ?, ?, ?, ?)",
+                (run_id, dataset, period, time.time(), job_id, json.dumps(files, ensure_ascii=False),
+                 json.dumps(detail_fields, ensure_ascii=False), json.dumps(summary_fields, ensure_ascii=False)))
+        return run_id
+
+    def add_hospitals(self, run_id, dataset, period, hospitals):
+        """Store (name, category, row values) tuples under a pending run."""
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT INTO hospitals (run_id, dataset, period, name, category, row) VALUES (?, ?, ?, ?, ?, ?)",
+                [(run_id, dataset, period, name, category, json.dumps(values, ensure_ascii=False))
+                 for name, category, values in hospitals])
+
+    def copy_hospitals(self, run_id, cache_key):
+        """Copy the hospitals of the latest accepted run with cache_key into a pending run.
+
+        Used for results served from the result cache, which are not parsed
+        again. Returns whether such a run was found.
+        """
+        with self._transaction() as connection:
+            source = connection.execute(
+                "SELECT run_id FROM runs WHERE cache_key = ? AND status = 'accepted' ORDER BY created DESC LIMIT 1",
+                (cache_key,)).fetchone()
+            if source is None:
+                return False
+            dataset, period = connection.execute("SELECT dataset, period FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+            connection.execute(
+                "INSERT INTO hospitals (run_id, dataset, period, name, category, row) "
+                "SELECT ?, ?, ?, name, category, row FROM hospitals WHERE run_id = ?",
+                (run_id, dataset, period, source[0]))
+        return True
+
+    def accept_run(self, run_id, summary, cache_key=None):
+        """Store the summary of a pending run and make it the run of its dataset and period.
+
+        summary maps each category to its metric values, in the order of the
+        run's summary_fields (category excluded). Returns the number of
+        hospitals the run holds.
+        """
+        with self._transaction() as connection:
+            dataset, period, summary_fields = connection.execute(
+                "SELECT dataset, period, summary_fields FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+            metrics = json.loads(summary_fields)[1:]
+            connection.executemany(
+                "INSERT INTO category_metrics (run_id, dataset, period, category, metric, value) VALUES (?, ?, ?, ?, ?, ?)",
+                [(run_id, dataset, period, category, metric, value)
+                 for category, values in summary.items() for metric, value in zip(metrics, values)])
+            superseded = [row[0] for row in connection.execute(
+                "SELECT run_id FROM runs WHERE dataset = ? AND period = ? AND status = 'accepted'", (dataset, period))]
+            self._delete_runs(connection, superseded)
+            hospital_count = connection.execute("SELECT COUNT(*) FROM hospitals WHERE run_id = ?", (run_id,)).fetchone()[0]
+            connection.execute("UPDATE runs SET status = 'accepted', cache_key = ?, hospital_count = ? WHERE run_id = ?",
+                               (cache_key, hospital_count, run_id))
+        return hospital_count
+
+    def discard_run(self, run_id):
+        with self._transaction() as connection:
+            self._delete_runs(connection, [run_id])
+
+    @staticmethod
+    def _period_range(column, start, end):
+        """SQL condition and parameters of an inclusive period range; open where start or end is None."""
+        conditions, params = [], []
+        if start is not None:
+            conditions.append(f" AND {column} >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append(f" AND {column} <= ?")
+            params.append(end)
+        return ''.join(conditions), params
+
+    @staticmethod
+    def _delete_runs(connection, run_ids):
+        for table in ('hospitals', 'category_metrics', 'runs'):
+            connection.executemany(f"DELETE FROM {table} WHERE run_id = ?", [(run_id,) for run_id in run_ids])
+
+    def runs(self, dataset, start=None, end=None):
+        """The accepted runs of a dataset, by period."""
+        condition, params = self._period_range('period', start, end)
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                "SELECT run_id, period, created, job_id, files, hospital_count FROM runs "
+                f"WHERE dataset = ? AND status = 'accepted'{condition} ORDER BY period", [dataset] + params)
+            return [{'run_id': run_id, 'period': period, 'created': created, 'job_id': job_id,
+                     'files': json.loads(files), 'hospitals': hospital_count}
+                    for run_id, period, created, job_id, files, hospital_count in rows]
+        finally:
+            connection.close()
+
+    def category_metrics(self, dataset, start=None, end=None, categories=None, metrics=None):
+        """(period, category, metric, value) of the accepted runs of a dataset, by period."""
+        condition, params = self._period_range('period', start, end)
+        query = "SELECT period, category, metric, value FROM category_metrics WHERE dataset = ?" + condition
+        params = [dataset] + params
+        for column, values in (('metric', metrics), ('category', categories)):
+            if values:
+                query += f" AND {column} IN ({', '.join('?' * len(values))})"
+                params += values
+        connection = self._connect()
+        try:
+            # Only accepted runs have category metrics
+            return connection.execute(query + " ORDER BY period, rowid", params).fetchall()
+        finally:
+            connection.close()
+
+    def hospitals(self, dataset, start=None, end=None, name=None, category=None, limit=1000):
+        """Stored rows of the hospitals of a dataset's accepted runs, as dicts of their fields."""
+        condition, params = self._period_range('hospitals.period', start, end)
+        query = ("SELECT hospitals.period, name, category, row, detail_fields FROM hospitals "
+                 "JOIN runs ON runs.run_id = hospitals.run_id "
+                 "WHERE hospitals.dataset = ? AND runs.status = 'accepted'" + condition)
+        params = [dataset] + params
+        if name is not None:
+            query += " AND name = ?"
+            params.append(name)
+        if category is not None:
+            query += " AND category = ?"
+            params.append(category)
+        query += " ORDER BY hospitals.period, hospitals.rowid LIMIT ?"
+        params.append(limit)
+        connection = self._connect()
+        try:
+            fields_cache = {}
+            hospitals = []
+            for period, name, category, row, detail_fields in connection.execute(query, params):
+                fields = fields_cache.get(detail_fields) or fields_cache.setdefault(detail_fields, json.loads(detail_fields))
+                hospitals.append({'period': period, 'name': name, 'category': category,
+                                  'row': dict(zip(fields, json.loads(row)))})
+            return hospitals
+        finally:
+            connection.close()
+
+
+class RunWriter:
+    """Picklable callback adding batches of detail records to a pending run, for detail worker processes.
+
+    to_hospitals turns a batch into the (name, category, row values) tuples
+    add_hospitals takes. The first failed write is kept in error and ends the
+    writing, so the job can drop the run.
+    """
+
+    def __init__(self, db_path, run_id, dataset, period, to_hospitals):
+        self.db_path = db_path
+        self.run_id = run_id
+        self.dataset = dataset
+        self.period = period
+        self.to_hospitals = to_hospitals
+        self.error = None
+        self._store = None
+
+    def __getstate__(self):
+        return {**self.__dict__, '_store': None}
+
+    def __call__(self, records):
+        if self.error is not None:
+            return
+        if self._store is None:
+            self._store = HistoryStore(self.db_path)
+        try:
+            self._store.add_hospitals(self.run_id, self.dataset, self.period, self.to_hospitals(records))
+        except sqlite3.Error as e:
+            self.error = str(e)
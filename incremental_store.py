@@ -0,0 +1,178 @@
+"""SQLite store of the last accepted detail rows, for incremental re-summarization.
+
+For every dataset the store keeps one row per hospital (its record hash and
+its contribution to the summary metrics) and the running per-category totals.
+A new upload only has to hand in the hospitals whose record hash changed and
+the ones that disappeared; the totals are corrected by the difference between
+their old and new contributions. The changes of an upload are only committed
+once its summary workbook is written. Uploads of a dataset take turns through
+its DatasetLock, from reading the stored hashes to committing, in every
+worker process.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hospitals (
+    dataset TEXT NOT NULL,
+    hospital_key TEXT NOT NULL,
+    category TEXT NOT NULL,
+    record_hash TEXT NOT NULL,
+    contribution TEXT NOT NULL,
+    PRIMARY KEY (dataset, hospital_key)
+);
+CREATE TABLE IF NOT EXISTS totals (
+    dataset TEXT NOT NULL,
+    category TEXT NOT NULL,
+    metrics TEXT NOT NULL,
+    PRIMARY KEY (dataset, category)
+);
+"""
+
+
+class IncrementalStore:
+    def __init__(self, db_path):
+        self.db_path = os.path.abspath(db_path)
+        self.lock_dir = self.db_path + '.locks'  # Lock files of the datasets
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        with self._schema_lock:
+            if not self._schema_ready:
+                connection.executescript(SCHEMA)
+                self._schema_ready = True
+        return connection
+
+    def load_hashes(self, dataset):
+        """Record hash of every stored hospital of a dataset, by hospital key."""
+        connection = self._connect()
+        try:
+            rows = connection.execute("SELECT hospital_key, record_hash FROM hospitals WHERE dataset = ?", (dataset,))
+            return dict(rows)
+        finally:
+            connection.close()
+
+    def dataset_lock(self, dataset):
+        """The DatasetLock of a dataset, shared by every thread and process using the store."""
+        name = hashlib.sha256(dataset.encode('utf-8')).hexdigest()
+        return DatasetLock(os.path.join(self.lock_dir, name + '.lock'))
+
+    def begin_changes(self, dataset, upserts, removed_keys, empty_metrics):
+        """Work out the totals of a dataset once hospitals are replaced and deleted; returns their PendingChanges.
+
+        upserts are (hospital_key, category, record_hash, contribution) tuples,
+        contribution being a list of metric values. Totals start from
+        empty_metrics for categories the dataset has not seen yet. Nothing is
+        written until the changes are committed; the caller holds the
+        dataset's lock from load_hashes on, so the stored rows stay as read.
+        """
+        connection = self._connect()
+        try:
+            totals = {category: json.loads(metrics) for category, metrics in connection.execute(
+                "SELECT category, metrics FROM totals WHERE dataset = ?", (dataset,))}
+
+            def add(category, contribution, sign):
+                current = totals.setdefault(category, list(empty_metrics))
+                totals[category] = [total + sign * value for total, value in zip(current, contribution)]
+
+            def remove(hospital_key):
+                row = connection.execute(
+                    "SELECT category, contribution FROM hospitals WHERE dataset = ? AND hospital_key = ?",
+                    (dataset, hospital_key)).fetchone()
+                if row is not None:
+                    add(row[0], json.loads(row[1]), -1)
+
+            for hospital_key in removed_keys:
+                remove(hospital_key)
+            for hospital_key, category, record_hash, contribution in upserts:
+                remove(hospital_key)
+                add(category, contribution, 1)
+            return PendingChanges(self, dataset, upserts, removed_keys, totals)
+        finally:
+            connection.close()
+
+    def _write_changes(self, changes):
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany("DELETE FROM hospitals WHERE dataset = ? AND hospital_key = ?",
+                                   [(changes.dataset, hospital_key) for hospital_key in changes.removed_keys])
+            connection.executemany(
+                "INSERT OR REPLACE INTO hospitals (dataset, hospital_key, category, record_hash, contribution) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(changes.dataset, hospital_key, category, record_hash, json.dumps(contribution))
+                 for hospital_key, category, record_hash, contribution in changes.upserts])
+            connection.executemany(
+                "INSERT OR REPLACE INTO totals (dataset, category, metrics) VALUES (?, ?, ?)",
+                [(changes.dataset, category, json.dumps(metrics)) for category, metrics in changes.totals.items()])
+            connection.execute("COMMIT")
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.close()
+
+
+class PendingChanges:
+    """The changes of IncrementalStore.begin_changes and the per-category totals they lead to."""
+
+    def __init__(self, store, dataset, upserts, removed_keys, totals):
+        self.store = store
+        self.dataset = dataset
+        self.upserts = upserts
+        self.removed_keys = removed_keys
+        self.totals = totals
+
+    def commit(self):
+        """Write the changes, in one transaction."""
+        self.store._write_changes(self)
+
+
+class DatasetLock:
+    """Exclusive lock of one dataset over all threads and processes, an flock on its lock file.
+
+    The operating system releases it if the holding process dies.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self, stop_event, timeout, poll_seconds):
+        """Wait for the lock, looking at stop_event every poll_seconds.
+
+        Returns False, without the lock, once stop_event is set or after
+        timeout seconds.
+        """
+        lock_file = open(self.path, 'ab')
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self._file = lock_file
+                    return True
+                except BlockingIOError:
+                    pass
+                if stop_event.is_set() or time.monotonic() >= deadline:
+                    lock_file.close()
+                    return False
+                stop_event.wait(poll_seconds)
+        except BaseException:
+            lock_file.close()
+            raise
+
+    def release(self):
+        lock_file, self._file = self._file, None
+        if lock_file is not None:
+            # Closing the file drops the flock
+            lock_file.close()
@@ -0,0 +1,65 @@
+"""Prometheus metrics of the web app, served by /metrics.
+
+Every finished job adds its stage timings, throughput, input size and memory
+to histograms kept in shared_state, so all gunicorn worker processes serve
+the same figures. The gauges are read when /metrics is requested.
+"""
+import math
+
+STAGE_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+ROWS_PER_SECOND_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000)
+INPUT_BYTES_BUCKETS = tuple(1024 * 4 ** n for n in range(2, 11))  # 16 KB to 1 GB
+RSS_BYTES_BUCKETS = tuple(1024 * 1024 * 2 ** n for n in range(5, 14))  # 32 MB to 8 GB
+
+# Name: (help text, bucket upper bounds)
+HISTOGRAMS = {
+    'lingling_stage_seconds': ("Seconds spent in each stage of a job", STAGE_SECONDS_BUCKETS),
+    'lingling_job_seconds': ("Seconds from queueing to the end of a job, by final status", STAGE_SECONDS_BUCKETS),
+    'lingling_job_rows_per_second': ("Detail rows read per second a job was running", ROWS_PER_SECOND_BUCKETS),
+    'lingling_job_input_bytes': ("Size of the workbooks uploaded for a job", INPUT_BYTES_BUCKETS),
+    'lingling_job_peak_rss_bytes': ("Peak resident memory of the processes running a job, sampled between stages",
+                                    RSS_BYTES_BUCKETS),
+}
+
+
+def observation(name, value, **labels):
+    """An observation of one of the HISTOGRAMS, as taken by SharedState.observe."""
+    return name, labels, value, HISTOGRAMS[name][1]
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def render(histograms, gauges):
+    """The Prometheus text exposition of the histograms and gauges.
+
+    histograms are (name, labels, sum, count, cumulative bucket counts) as
+    returned by SharedState.histograms; gauges are (name, help text, value).
+    """
+    lines = []
+    for name, help_text, value in gauges:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {format_value(value)}"]
+    by_name = {}
+    for name, labels, total, count, buckets in histograms:
+        by_name.setdefault(name, []).append((labels, total, count, buckets))
+    for name, (help_text, bounds) in HISTOGRAMS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for labels, total, count, buckets in by_name.get(name, []):
+            for bound, bucket_count in zip(bounds, buckets):
+                lines.append(f"{name}_bucket{format_labels({**labels, 'le': format_value(float(bound))})} {bucket_count}")
+            lines.append(f"{name}_bucket{format_labels({**labels, 'le': '+Inf'})} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {format_value(float(total))}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,109 @@
+"""Content-addressed cache of summarization results on disk.
+
+Each entry lives in its own directory named after the key and holds the
+summarized data as JSON plus the rendered output workbook. Entries are
+evicted least-recently-used first once the cache grows past max_bytes, and
+unconditionally once they have not been used for max_age seconds.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+SUMMARY_FILE = 'summary.json'
+
+
+class CacheEntry:
+    def __init__(self, key, summary, output_path):
+        self.key = key
+        self.summary = summary
+        self.output_path = output_path
+
+
+class ResultCache:
+    def __init__(self, directory, max_bytes, max_age):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(file_digests, schema):
+        """Combine the digests of the input files, in order, with the field schema."""
+        digest = hashlib.sha256()
+        digest.update(json.dumps(schema, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+        for file_digest in file_digests:
+            digest.update(file_digest)
+        return digest.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Return the CacheEntry for key, or None on a miss.
+
+        Entries unused for more than max_age seconds are misses, and are
+        evicted along with any other expired ones.
+        """
+        entry_dir = self._entry_dir(key)
+        try:
+            if time.time() - os.stat(entry_dir).st_mtime > self.max_age:
+                with self._lock:
+                    self._evict()
+                return None
+            with open(os.path.join(entry_dir, SUMMARY_FILE), encoding='utf-8') as f:
+                meta = json.load(f)
+            output_path = os.path.join(entry_dir, meta['output'])
+            if not os.path.exists(output_path):
+                return None
+            # The directory mtime doubles as the LRU timestamp
+            os.utime(entry_dir)
+        except (OSError, ValueError, KeyError):
+            return None
+        return CacheEntry(key, meta['summary'], output_path)
+
+    def put(self, key, summary, output_data, output_ext):
+        """Store a result and return its CacheEntry."""
+        output_name = 'output' + output_ext
+        staging_dir = os.path.join(self.directory, f'.tmp-{uuid.uuid4()}')
+        os.makedirs(staging_dir)
+        try:
+            with open(os.path.join(staging_dir, output_name), 'wb') as f:
+                f.write(output_data)
+            with open(os.path.join(staging_dir, SUMMARY_FILE), 'w', encoding='utf-8') as f:
+                json.dump({'summary': summary, 'output': output_name, 'created': time.time()}, f, ensure_ascii=False)
+            with self._lock:
+                entry_dir = self._entry_dir(key)
+                if os.path.exists(entry_dir):
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                os.rename(staging_dir, entry_dir)
+                self._evict()
+        finally:
+            if os.path.exists(staging_dir):
+                shutil.rmtree(staging_dir, ignore_errors=True)
+        return CacheEntry(key, summary, os.path.join(entry_dir, output_name))
+
+    def _evict(self):
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            entry_dir = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+                entries.append((os.stat(entry_dir).st_mtime, size, entry_dir))
+            except OSError:
+                continue
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, entry_dir in entries:
+            if total <= self.max_bytes and now - mtime <= self.max_age:
+                continue
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
@@ -0,0 +1,325 @@
+"""Session, log and job state shared by all worker processes of the web app.
+
+Behind gunicorn every request may land in a different process, so the state
+the browser polls or streams lives in a local SQLite database (WAL mode):
+
+* sessions: last activity, latest progress update and log byte count,
+* log_lines: the bounded log of every session, numbered per session so each
+  /logs stream can follow it with its own cursor,
+* job_events: the end of every job, sent on /logs after the job's last log line,
+* jobs: the status of every job as served by /jobs/<id>, where its result is
+  and whether /stop asked for it to be cancelled,
+* histograms and process_gauges: the figures served by /metrics.
+
+The process running a job remains its owner; the others only read its record
+and set the cancel flag. Upserts are written as INSERT OR IGNORE plus UPDATE,
+since ON CONFLICT clauses need SQLite 3.24 and CentOS 7 ships 3.7.17.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    last_seen REAL NOT NULL,
+    next_seq INTEGER NOT NULL DEFAULT 1,
+    log_bytes INTEGER NOT NULL DEFAULT 0,
+    progress TEXT,
+    progress_seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS log_lines (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    line TEXT NOT NULL,
+    PRIMARY KEY (session_id, seq)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    state TEXT NOT NULL,
+    output_path TEXT,
+    output_name TEXT,
+    pid INTEGER NOT NULL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_session ON jobs (session_id);
+CREATE TABLE IF NOT EXISTS job_events (
+    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    after_seq INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_events_session ON job_events (session_id, event_id);
+CREATE TABLE IF NOT EXISTS histograms (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    sum REAL NOT NULL,
+    count INTEGER NOT NULL,
+    buckets TEXT NOT NULL,
+    PRIMARY KEY (name, labels)
+);
+CREATE TABLE IF NOT EXISTS process_gauges (
+    pid INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (pid, name)
+);
+"""
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+class SharedState:
+    def __init__(self, db_path):
+        # Absolute, as every thread opens its own connection
+        self.db_path = os.path.abspath(db_path)
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+
+    def _connection(self):
+        # One connection per thread; sqlite3 connections can't be shared
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _transaction(self, work):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(connection)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return result
+
+    def touch_session(self, session_id):
+        def work(connection):
+            now = time.time()
+            connection.execute("INSERT OR IGNORE INTO sessions (session_id, last_seen) VALUES (?, ?)", (session_id, now))
+            connection.execute("UPDATE sessions SET last_seen = ? WHERE session_id = ?", (now, session_id))
+        self._transaction(work)
+
+    def append_lines(self, session_id, lines, max_lines, max_bytes):
+        """Append log lines to a session, dropping its oldest lines beyond max_lines or max_bytes."""
+        def work(connection):
+            connection.execute("INSERT OR IGNORE INTO sessions (session_id, last_seen) VALUES (?, ?)",
+                               (session_id, time.time()))
+            next_seq, log_bytes = connection.execute(
+                "SELECT next_seq, log_bytes FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            connection.executemany("INSERT INTO log_lines (session_id, seq, line) VALUES (?, ?, ?)",
+                                   [(session_id, next_seq + i, line) for i, line in enumerate(lines)])
+            next_seq += len(lines)
+            log_bytes += sum(len(line) for line in lines)
+            # Ring buffer: forget the oldest lines
+            cutoff = next_seq - 1 - max_lines
+            if cutoff > 0:
+                log_bytes -= connection.execute(
+                    "SELECT COALESCE(SUM(length(line)), 0) FROM log_lines WHERE session_id = ? AND seq <= ?",
+                    (session_id, cutoff)).fetchone()[0]
+            if log_bytes > max_bytes:
+                for seq, size in connection.execute(
+                        "SELECT seq, length(line) FROM log_lines WHERE session_id = ? AND seq > ? ORDER BY seq",
+                        (session_id, cutoff)):
+                    if log_bytes <= max_bytes:
+                        break
+                    log_bytes -= size
+                    cutoff = seq
+            if cutoff > 0:
+                connection.execute("DELETE FROM log_lines WHERE session_id = ? AND seq <= ?", (session_id, cutoff))
+                connection.execute("DELETE FROM job_events WHERE session_id = ? AND after_seq < ?", (session_id, cutoff))
+            connection.execute("UPDATE sessions SET next_seq = ?, log_bytes = ? WHERE session_id = ?",
+                               (next_seq, log_bytes, session_id))
+        self._transaction(work)
+
+    def log_end(self, session_id):
+        """Sequence number of the last log line written to a session, 0 if none."""
+        row = self._connection().execute("SELECT next_seq FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] - 1 if row else 0
+
+    def session_stamps(self, session_ids):
+        """(next_seq, progress_seq, last job event id) of each session, which change with every write to it."""
+        if not session_ids:
+            return {}
+        rows = self._connection().execute(
+            "SELECT session_id, next_seq, progress_seq, "
+            "(SELECT MAX(event_id) FROM job_events WHERE job_events.session_id = sessions.session_id) "
+            f"FROM sessions WHERE session_id IN ({', '.join('?' * len(session_ids))})", list(session_ids)).fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def read_lines(self, session_id, after_seq):
+        """Log lines of a session after after_seq; returns (lines, last seq, lines dropped before them)."""
+        connection = self._connection()
+        rows = connection.execute("SELECT seq, line FROM log_lines WHERE session_id = ? AND seq > ? ORDER BY seq",
+                                  (session_id, after_seq)).fetchall()
+        if not rows:
+            return [], after_seq, 0
+        return [line for _, line in rows], rows[-1][0], rows[0][0] - after_seq - 1
+
+    def add_job_event(self, session_id, event):
+        """Queue an event for the /logs streams of a session, to follow the log lines written so far."""
+        def work(connection):
+            connection.execute("INSERT INTO job_events (session_id, after_seq, data) VALUES (?, ?, ?)",
+                               (session_id, self.log_end(session_id), json.dumps(event, ensure_ascii=False)))
+        self._transaction(work)
+
+    def read_job_events(self, session_id, after_event_id, through_seq):
+        """Events of a session after after_event_id that follow no log line beyond through_seq.
+
+        Returns (events, id of the last one).
+        """
+        rows = self._connection().execute(
+            "SELECT event_id, data FROM job_events WHERE session_id = ? AND event_id > ? AND after_seq <= ? "
+            "ORDER BY event_id", (session_id, after_event_id, through_seq)).fetchall()
+        if not rows:
+            return [], after_event_id
+        return [json.loads(data) for _, data in rows], rows[-1][0]
+
+    def set_progress(self, session_id, progress):
+        def work(connection):
+            connection.execute("INSERT OR IGNORE INTO sessions (session_id, last_seen) VALUES (?, ?)",
+                               (session_id, time.time()))
+            connection.execute("UPDATE sessions SET progress = ?, progress_seq = progress_seq + 1 WHERE session_id = ?",
+                               (json.dumps(progress, ensure_ascii=False), session_id))
+        self._transaction(work)
+
+    def read_progress(self, session_id):
+        """Latest progress update of a session as (sequence number, progress)."""
+        row = self._connection().execute("SELECT progress_seq, progress FROM sessions WHERE session_id = ?",
+                                         (session_id,)).fetchone()
+        if row is None or row[1] is None:
+            return (row[0] if row else 0), None
+        return row[0], json.loads(row[1])
+
+    def clear_session(self, session_id):
+        """Drop the log lines, job events and progress of a session."""
+        def work(connection):
+            connection.execute("DELETE FROM log_lines WHERE session_id = ?", (session_id,))
+            connection.execute("DELETE FROM job_events WHERE session_id = ?", (session_id,))
+            connection.execute("UPDATE sessions SET log_bytes = 0, progress = NULL WHERE session_id = ?", (session_id,))
+        self._transaction(work)
+
+    def save_job(self, job_id, session_id, state, output_path=None, output_name=None):
+        """Insert or update the record of a job owned by this process."""
+        def work(connection):
+            connection.execute(
+                "INSERT OR IGNORE INTO jobs (job_id, session_id, status, state, pid) VALUES (?, ?, '', '', ?)",
+                (job_id, session_id, os.getpid()))
+            connection.execute(
+                "UPDATE jobs SET status = ?, state = ?, output_path = ?, output_name = ? WHERE job_id = ?",
+                (state['status'], json.dumps(state, ensure_ascii=False), output_path, output_name, job_id))
+        self._transaction(work)
+
+    def load_job(self, job_id):
+        """The record of a job as a dict with session_id, state, output_path and output_name, or None."""
+        row = self._connection().execute(
+            "SELECT session_id, state, output_path, output_name FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {'session_id': row[0], 'state': json.loads(row[1]), 'output_path': row[2], 'output_name': row[3]}
+
+    def request_cancel(self, session_id):
+        """Flag the queued and running jobs of a session for cancellation; returns their ids."""
+        def work(connection):
+            job_ids = [job_id for job_id, in connection.execute(
+                "SELECT job_id FROM jobs WHERE session_id = ? AND status IN (?, ?)", (session_id, *ACTIVE_STATUSES))]
+            connection.executemany("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ?", [(job_id,) for job_id in job_ids])
+            return job_ids
+        return self._transaction(work)
+
+    def cancel_requested(self, job_ids):
+        """The subset of job_ids that were flagged for cancellation."""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return set()
+        placeholders = ', '.join('?' * len(job_ids))
+        return {job_id for job_id, in self._connection().execute(
+            f"SELECT job_id FROM jobs WHERE cancel_requested = 1 AND job_id IN ({placeholders})", job_ids)}
+
+    def fail_orphaned_jobs(self, is_alive):
+        """Mark queued and running jobs whose owning process is gone as failed; returns how many."""
+        connection = self._connection()
+        pids = [pid for pid, in connection.execute(
+            "SELECT DISTINCT pid FROM jobs WHERE status IN (?, ?)", ACTIVE_STATUSES)]
+        failed = 0
+        for pid in pids:
+            if is_alive(pid):
+                continue
+            for job_id, state in connection.execute(
+                    "SELECT job_id, state FROM jobs WHERE pid = ? AND status IN (?, ?)", (pid, *ACTIVE_STATUSES)).fetchall():
+                state = json.loads(state)
+                state.update(status='failed', error='The worker process running the job exited.', finished=time.time())
+                connection.execute("UPDATE jobs SET status = 'failed', state = ? WHERE job_id = ?",
+                                   (json.dumps(state, ensure_ascii=False), job_id))
+                failed += 1
+        return failed
+
+    def expire_sessions(self, ttl):
+        """Delete sessions idle for more than ttl seconds and without active jobs; returns their ids."""
+        def work(connection):
+            session_ids = [session_id for session_id, in connection.execute(
+                "SELECT session_id FROM sessions WHERE last_seen < ? AND session_id NOT IN "
+                "(SELECT session_id FROM jobs WHERE status IN (?, ?))", (time.time() - ttl, *ACTIVE_STATUSES))]
+            for table in ('log_lines', 'job_events', 'jobs', 'sessions'):
+                connection.executemany(f"DELETE FROM {table} WHERE session_id = ?", [(session_id,) for session_id in session_ids])
+            return session_ids
+        return self._transaction(work)
+
+    def gauges(self):
+        """Number of sessions and the log bytes they hold, over all processes."""
+        sessions, log_bytes = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(log_bytes), 0) FROM sessions").fetchone()
+        return {'sessions': sessions, 'bytes': log_bytes}
+
+    def job_counts(self):
+        """Number of jobs in each status, over all processes."""
+        return dict(self._connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def observe(self, observations):
+        """Add (name, labels, value, bucket upper bounds) observations to the histograms."""
+        def work(connection):
+            for name, labels, value, bounds in observations:
+                labels = json.dumps(labels, sort_keys=True, ensure_ascii=False)
+                row = connection.execute("SELECT buckets FROM histograms WHERE name = ? AND labels = ?",
+                                         (name, labels)).fetchone()
+                counts = json.loads(row[0]) if row else []
+                if len(counts) != len(bounds):
+                    # New histogram, or its buckets changed: start over
+                    connection.execute("DELETE FROM histograms WHERE name = ? AND labels = ?", (name, labels))
+                    counts = [0] * len(bounds)
+                counts = [count + (value <= bound) for count, bound in zip(counts, bounds)]
+                connection.execute("INSERT OR IGNORE INTO histograms (name, labels, sum, count, buckets) VALUES (?, ?, 0, 0, '')",
+                                   (name, labels))
+                connection.execute("UPDATE histograms SET sum = sum + ?, count = count + 1, buckets = ? "
+                                   "WHERE name = ? AND labels = ?", (value, json.dumps(counts), name, labels))
+        self._transaction(work)
+
+    def histograms(self):
+        """Every histogram as (name, labels, sum, count, cumulative bucket counts)."""
+        return [(name, json.loads(labels), total, count, json.loads(buckets)) for name, labels, total, count, buckets in
+                self._connection().execute("SELECT name, labels, sum, count, buckets FROM histograms ORDER BY name, labels")]
+
+    def set_process_gauge(self, name, value):
+        """Set a gauge of this process; process_gauges adds it up over all processes."""
+        self._connection().execute("INSERT OR REPLACE INTO process_gauges (pid, name, value) VALUES (?, ?, ?)",
+                                   (os.getpid(), name, value))
+
+    def process_gauges(self, is_alive):
+        """Sum of every process gauge over the live processes; those of exited processes are dropped."""
+        connection = self._connection()
+        totals = {}
+        for pid, name, value in connection.execute("SELECT pid, name, value FROM process_gauges").fetchall():
+            if is_alive(pid):
+                totals[name] = totals.get(name, 0) + value
+            else:
+                connection.execute("DELETE FROM process_gauges WHERE pid = ?", (pid,))
+        return totals
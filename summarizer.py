@@ -0,0 +1,874 @@
+"""Reading, validating, summarizing and writing back the lingling workbooks.
+
+This module has no Flask dependency, so the web app (app.py) and the batch
+command line (cli.py) share it. openpyxl, xlrd, xlwt and numpy are
+imported where they are first needed: a run only loads the libraries of the
+formats it actually touches.
+"""
+import contextlib
+import io
+import itertools
+import json
+import logging
+import mmap
+import operator
+import os
+import time
+from threading import Event
+
+SUMMARY_CHUNK_ROWS = 10000  # Detail rows aggregated per vectorised batch
+SCHEMA_PROBE_ROWS = 30  # Leading rows searched for the header and category rows of a sheet
+PROGRESS_INTERVAL_SECONDS = 0.25  # Minimum time between two progress updates of a job
+CANCEL_CHECK_ROWS = 256  # Rows read or logged between two looks at the stop event
+ON_BATCH_ROWS = 1000  # Detail records per on_batch call, with a look at the stop event between calls
+
+
+class ProcessingStopped(Exception):
+    """Raised from inside a stage once its stop event is set."""
+
+
+class StopFile:
+    """A stop event for worker processes, set once its file exists.
+
+    The file system is looked at no more often than every interval seconds.
+    """
+
+    def __init__(self, path, interval=0.05):
+        self.path = path
+        self.interval = interval
+        self._checked = None
+        self._set = False
+
+    def is_set(self):
+        if not self._set:
+            now = time.monotonic()
+            if self._checked is None or now - self._checked >= self.interval:
+                self._checked = now
+                self._set = os.path.exists(self.path)
+        return self._set
+
+
+def read_excel(file_path, processing_logger, stop_event, file_contents=None):
+    """Load the first sheet of an Excel file.
+
+    With file_contents the workbook is parsed from those bytes and file_path
+    only tells the format.
+    """
+    processing_logger.info(f"Reading file: {file_path}")
+    if stop_event.is_set():
+        processing_logger.warning("Processing stopped by user during file read.")
+        return None, None, None
+    try:
+        if file_path.endswith('.xlsx'):
+            import openpyxl
+            wb = openpyxl.load_workbook(file_path if file_contents is None else io.BytesIO(file_contents))
+            sheet = wb.active
+            data = [[cell.value for cell in row] for row in sheet.iter_rows()]
+            return data, wb, sheet
+        else:
+            import xlrd
+            book = xlrd.open_workbook(file_path, formatting_info=True, file_contents=file_contents)
+            sheet = book.sheet_by_index(0)
+            data = [sheet.row_values(rowx) for rowx in range(sheet.nrows)]
+            return data, book, sheet
+    except Exception as e:
+        processing_logger.error(f"Error reading file: {e}")
+        return None, None, None
+
+
+class SheetRows:
+    """The rows of a sheet as streamed by read_excel_rows.
+
+    Setting max_col cuts the rows read afterwards at that 0-based column; the
+    .xlsx reader then skips the cells right of it without parsing them.
+    Raises ProcessingStopped once stop_event is set.
+    """
+
+    def __init__(self, iter_rows, source, stop_event):
+        self.max_col = None
+        self._rows = iter_rows(self, source, stop_event)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._rows)
+
+    def close(self):
+        self._rows.close()
+
+
+def read_excel_rows(file_path, processing_logger, stop_event, file_contents=None):
+    """Stream the first sheet of an Excel file row by row.
+
+    Unlike read_excel the workbook is never fully materialised: .xlsx sheets
+    are parsed values-only by xlsx_reader, .xls sheets are loaded on demand.
+    file_contents works as in read_excel. Returns the SheetRows, or None if
+    the file cannot be opened.
+    """
+    processing_logger.info(f"Streaming file: {file_path}")
+    if stop_event.is_set():
+        processing_logger.warning("Processing stopped by user during file read.")
+        return None
+    try:
+        if file_path.endswith('.xlsx'):
+            from xlsx_reader import XlsxReader
+            reader = XlsxReader(file_path if file_contents is None else io.BytesIO(file_contents))
+            return SheetRows(_iter_xlsx_rows, reader, stop_event)
+        else:
+            import xlrd
+            book = xlrd.open_workbook(file_path, on_demand=True, file_contents=file_contents)
+            return SheetRows(_iter_xls_rows, book, stop_event)
+    except Exception as e:
+        processing_logger.error(f"Error reading file: {e}")
+        return None
+
+
+def _iter_xlsx_rows(rows, reader, stop_event):
+    try:
+        for n, row in enumerate(reader.iter_rows(lambda: rows.max_col)):
+            if n % CANCEL_CHECK_ROWS == 0 and stop_event.is_set():
+                raise ProcessingStopped()
+            yield row
+    finally:
+        reader.close()
+
+
+def _iter_xls_rows(rows, book, stop_event):
+    try:
+        # xlrd parses the whole sheet here; only the rows can be cut short
+        sheet = book.sheet_by_index(0)
+        for rowx in range(sheet.nrows):
+            if rowx % CANCEL_CHECK_ROWS == 0 and stop_event.is_set():
+                raise ProcessingStopped()
+            yield sheet.row_values(rowx, 0, rows.max_col)
+    finally:
+        book.release_resources()
+
+
+class SheetSchema:
+    """Where a schema probe found the fields of a sheet.
+
+    header_row is the 0-based row of the field names, columns maps each
+    location of the field dictionary to its 0-based sheet column and, for
+    summary sheets, category_rows maps each hospital category to its row.
+    """
+
+    def __init__(self, header_row, columns, category_rows=None):
+        self.header_row = header_row
+        self.columns = columns
+        self.category_rows = category_rows
+
+    def column_list(self):
+        return [self.columns[location] for location in range(len(self.columns))]
+
+
+def locate_columns(fields_dict, row):
+    """Map every field of fields_dict to the column of row whose header contains it.
+
+    The column the field is expected in is tried first. Returns the column
+    map and the names of the fields that were not found.
+    """
+    cells = [cell if isinstance(cell, str) else '' for cell in row]
+    columns, missing = {}, []
+    for location, field_name in fields_dict.items():
+        if location < len(cells) and field_name in cells[location] and location not in columns.values():
+            columns[location] = location
+            continue
+        for idx, cell in enumerate(cells):
+            if field_name in cell and idx not in columns.values():
+                columns[location] = idx
+                break
+        else:
+            missing.append(field_name)
+    return columns, missing
+
+
+def find_header(fields_dict, rows):
+    """Return (row index, column map) of the first of rows that holds every field of fields_dict.
+
+    Raises ValueError naming the fields missing from the closest candidate.
+    """
+    best = None
+    for row_idx, row in enumerate(rows):
+        columns, missing = locate_columns(fields_dict, row or ())
+        if not missing:
+            return row_idx, columns
+        if best is None or len(missing) < len(best[1]):
+            best = (row, missing)
+    if best is None:
+        raise ValueError("The sheet is empty.")
+    row, missing = best
+    raise ValueError(f"Field '{missing[0]}' not found in {list(row)}.")
+
+
+def probe_detail_schema(rows):
+    """Locate the header of a detail sheet within its first SCHEMA_PROBE_ROWS rows."""
+    header_row, columns = find_header(large_data_field_dic, itertools.islice(rows, SCHEMA_PROBE_ROWS))
+    return SheetSchema(header_row, columns)
+
+
+def probe_summary_schema(rows):
+    """Locate the header and the hospital category rows of a summary sheet within its first SCHEMA_PROBE_ROWS rows."""
+    rows = list(itertools.islice(rows, SCHEMA_PROBE_ROWS))
+    header_row, columns = find_header(summary_data_field_dic, rows)
+    category_column = columns[0]
+    category_rows = {}
+    for category in SUMMARY_CATEGORY_ROWS:
+        for row_idx in range(header_row + 1, len(rows)):
+            row = rows[row_idx]
+            cell = row[category_column] if row is not None and category_column < len(row) else None
+            if isinstance(cell, str) and category in cell and row_idx not in category_rows.values():
+                category_rows[category] = row_idx
+                break
+        else:
+            expected_row = SUMMARY_CATEGORY_ROWS[category]
+            raise ValueError(f"{category} is not in row {expected_row + 1}, column {category_column + 1} "
+                             f"or any other row of the first {SCHEMA_PROBE_ROWS}")
+    return SheetSchema(header_row, columns, category_rows)
+
+
+def probe_workbook(file_name, file_path, probe, processing_logger, file_contents=None):
+    """Run a schema probe on the first rows of a workbook without parsing the rest.
+
+    probe is probe_detail_schema or probe_summary_schema; its ValueError
+    propagates, as does one for a file that can't be opened.
+    """
+    rows = read_excel_rows(file_path, processing_logger, Event(), file_contents=file_contents)
+    if rows is None:
+        raise ValueError(f"{file_name} could not be read as an Excel workbook.")
+    try:
+        return probe(rows)
+    except ValueError as e:
+        raise ValueError(f"{file_name}: {e}") from None
+    finally:
+        rows.close()
+
+
+# Hospital categories, with their row in the standard summary sheet
+SUMMARY_CATEGORY_ROWS = {
+    "三级甲等医院": 4,
+    "三级公立医院": 5,
+    "三级民营医院": 6,
+    "二级公立医院": 7,
+    "二级民营医院": 8,
+}
+
+DETAIL_NULL_TOKENS = ('/',)  # Detail cells that count as 0, besides blank ones
+
+
+class DetailColumn:
+    """A column of the detail sheet and how its cells are read.
+
+    kind is 'name' (the hospital, never aggregated), 'category' (one of
+    SUMMARY_CATEGORY_ROWS), 'flag' (1 if filled in, else 0) or 'number'.
+    allowed, if given, lists the only values a number column may hold.
+    """
+
+    def __init__(self, header, kind='number', allowed=None):
+        self.header = header
+        self.kind = kind
+        self.allowed = allowed
+
+
+class SummaryMetric:
+    """A column of the summary sheet.
+
+    Its value for a category is the sum, over the category's hospitals, of the
+    detail columns at the given indexes in DETAIL_COLUMNS, each truncated to
+    an integer first unless dtype is float. Without columns every hospital
+    counts as one.
+    """
+
+    def __init__(self, field_name, columns=(), dtype=int):
+        self.field_name = field_name
+        self.columns = tuple(columns)
+        self.dtype = dtype
+
+
+# The detail sheet, in its standard column order; add a column here and a
+# metric below to extend the summary.
+DETAIL_COLUMNS = (
+    DetailColumn("医疗机构名称", 'name'),
+    DetailColumn("医疗机构分类", 'category'),
+    DetailColumn("是否参加国家卫生健康委员会临床检验中心室间质量评价并合格", 'flag'),
+    DetailColumn("通过国家室间质评医学检验结果合格项目数量"),
+    DetailColumn("是否参加辽宁省临床检验中心室间质量评价并合格"),
+    DetailColumn("通过辽宁省室间质评医学检验结果合格项目数量"),
+    DetailColumn("是否参加辽宁省医学影像质控中心影像质控认证评价并合格", allowed=(0, 1)),
+    DetailColumn("要求对其他医疗机构标有互认标识的医学影像检查资料和医学检验结果认可"),
+    DetailColumn("DR互认项目数"),
+    DetailColumn("DR节约检查费用"),
+    DetailColumn("MR互认项目数"),
+    DetailColumn("MR节约检查费用"),
+    DetailColumn("CT互认项目数"),
+    DetailColumn("CT节约检查费用"),
+    DetailColumn("临床检验互认项目数"),
+    DetailColumn("临床检验节约检查费用"),
+    DetailColumn("通过信息系统调阅成员医院间医学影像检查资料和医学检验结果频"),
+    # "总项目" and "总费用" are recomputed, not read
+)
+
+# The summary sheet's metric columns, in sheet order after "医疗机构分类"
+SUMMARY_METRICS = (
+    SummaryMetric("医院总数量"),
+    SummaryMetric("参加国家卫生健康委员会临床检验中心室间质量评价合格医院数量", (2,)),
+    SummaryMetric("通过国家室间质评平均合格项目数量", (3,)),
+    SummaryMetric("参加辽宁省临床检验中心室间质量评价合格医院数量", (4,)),
+    SummaryMetric("通过辽宁省室间质评平均合格项目数量", (5,)),
+    SummaryMetric("参加辽宁省医学影像质控中心影像质控认证评价合格医院数量", (6,)),
+    SummaryMetric("要求对其他医疗机构标有互认标识的医学影像检查资料和医学检验结果认可的医院数量", (7,)),
+    SummaryMetric("认可其他医疗机构标有互认标识的医学影像检查资料和医学检验结果", (8, 10, 12, 14)),
+    SummaryMetric("联盟医院间通过信息系统调阅成员医院间医学影像检查资料和医学检验结果频次合计", (16,)),
+    SummaryMetric("实施检查检验结果互认为患者节约医疗费用", (9, 11, 13, 15), float),
+)
+
+
+summary_data_field_dic = {0: "医疗机构分类"}
+summary_data_field_dic.update({idx: metric.field_name for idx, metric in enumerate(SUMMARY_METRICS, 1)})
+
+large_data_field_dic = {idx: column.header for idx, column in enumerate(DETAIL_COLUMNS)}
+
+
+class MetricKernel:
+    """DETAIL_COLUMNS and SUMMARY_METRICS compiled into plain index tuples.
+
+    Built once at import; detail_metrics only walks these tuples, so it
+    converts each detail column a metric reads exactly once and never looks
+    at the others.
+    """
+
+    def __init__(self, detail_columns, metrics):
+        kinds = [column.kind for column in detail_columns]
+        self.name_column = kinds.index('name')
+        self.category_column = kinds.index('category')
+        used = sorted({idx for metric in metrics for idx in metric.columns})
+        for idx in used:
+            if kinds[idx] not in ('flag', 'number'):
+                raise ValueError(f"Metric column {detail_columns[idx].header} is not a flag or number column")
+        # (column index, is a flag, allowed values or None) of every column read
+        self.value_columns = tuple((idx, kinds[idx] == 'flag', detail_columns[idx].allowed) for idx in used)
+        self.truncated_columns = tuple(sorted({idx for metric in metrics if metric.dtype is int for idx in metric.columns}))
+        # (source column indexes, is an integer metric) in summary sheet order
+        self.metrics = tuple((metric.columns, metric.dtype is int) for metric in metrics)
+        self.headers = tuple(column.header for column in detail_columns)
+        self.empty_row = tuple(metric.dtype() for metric in metrics)
+
+
+METRIC_KERNEL = MetricKernel(DETAIL_COLUMNS, SUMMARY_METRICS)
+
+
+def validate_summary_data(file_name, summary_data, processing_logger):
+    """Check the summary sheet's rows and return its SheetSchema."""
+    processing_logger.info(f"Validating data for: {file_name}")
+    schema = probe_summary_schema(summary_data)
+    processing_logger.info(f"Data validation successful for {file_name}.")
+    return schema
+
+
+def validate_large_data(file_name, large_data, processing_logger):
+    """Check the leading rows of a detail sheet and return its SheetSchema."""
+    processing_logger.info(f"Validating data for: {file_name}")
+    schema = probe_detail_schema(large_data)
+    processing_logger.info(f"Data validation successful for {file_name}.")
+    return schema
+
+
+# Sections of the detail sheet, in the order they appear.
+DETAIL_HEADER, DETAIL_DATA, DETAIL_FOOTER = range(3)
+
+
+def iter_detail_records(rows, columns=None):
+    """Yield the raw hospital rows between the "总计" and "注" markers.
+
+    Single pass over any iterator of rows: a small state machine walks the
+    header, data and footer sections, and missing markers are reported only
+    once the input is exhausted. Each record is projected (and padded) to the
+    len(large_data_field_dic) detail columns; columns, a SheetSchema's
+    column_list(), says where they are in the sheet if not in the first ones.
+    """
+    width = len(large_data_field_dic)
+    padding = (None,) * width
+    if columns is None or columns == list(range(width)):
+        project = None
+        name_column = 0
+    else:
+        # Pad every row to the last column used, then pick the columns
+        padding = (None,) * (max(columns) + 1)
+        project = operator.itemgetter(*columns)
+        name_column = columns[0]
+    state = DETAIL_HEADER
+    for row in rows:
+        if not row or len(row) <= name_column or not isinstance(row[name_column], str):
+            continue
+        if "总计" in row[name_column]:
+            state = DETAIL_DATA
+            continue
+        if state == DETAIL_DATA:
+            if "注" in row[name_column]:
+                state = DETAIL_FOOTER
+                break
+            if project is None:
+                record = tuple(row[:width])
+                yield record + padding[len(record):]
+            else:
+                record = tuple(row)
+                yield project(record + padding[len(record):])
+
+    if state == DETAIL_HEADER:
+        raise ValueError("No '总计' row found in large Excel data.")
+    if state == DETAIL_DATA:
+        raise ValueError("No '注' row found in large Excel data.")
+
+
+def normalize_detail_value(value):
+    """Blank detail cells and DETAIL_NULL_TOKENS count as 0."""
+    if not value or value in DETAIL_NULL_TOKENS:
+        value = 0
+    return value
+
+
+def hospital_rows(records):
+    """(name, category, normalized values) of raw detail records, the form history_store keeps them in."""
+    name_column, category_column = METRIC_KERNEL.name_column, METRIC_KERNEL.category_column
+    return [(str(record[name_column]).strip(), str(record[category_column] or '').strip(),
+             [normalize_detail_value(value) for value in record])
+            for record in records]
+
+
+def get_one_row_data(rows):
+    field_names = [large_data_field_dic[idx] for idx in range(len(large_data_field_dic))]
+    for record in iter_detail_records(rows):
+        yield_dict = dict()
+        for dict_key, value in zip(field_names, record):
+            yield_dict[dict_key] = normalize_detail_value(value)
+        yield yield_dict
+
+
+def iter_batches(records, max_rows, max_seconds):
+    """Group records into lists of up to max_rows, cut short after max_seconds.
+
+    The time limit keeps progress updates flowing when rows arrive slowly,
+    e.g. while a large workbook is still being parsed.
+    """
+    batch = []
+    started = time.monotonic()
+    for record in records:
+        batch.append(record)
+        if len(batch) >= max_rows or (len(batch) % 256 == 0 and time.monotonic() - started >= max_seconds):
+            yield batch
+            batch = []
+            started = time.monotonic()
+    if batch:
+        yield batch
+
+
+def detail_metrics(records):
+    """Per-row summary metrics of a batch of raw detail records.
+
+    Returns the category of each row and one array per SUMMARY_METRICS entry,
+    int64 for integer metrics and float64 for the others.
+    """
+    import numpy as np
+
+    kernel = METRIC_KERNEL
+    columns = list(zip(*records))
+
+    def cells(idx):
+        # Blank cells and DETAIL_NULL_TOKENS count as 0, same as normalize_detail_value
+        column = np.array(columns[idx], dtype=object)
+        blank = ~column.astype(bool)
+        for token in DETAIL_NULL_TOKENS:
+            blank |= column == token
+        column[blank] = 0
+        return column
+
+    def numbers(idx, allowed):
+        column = columns[idx]
+        if str not in set(map(type, column)):
+            # Purely numeric columns convert in one go, blanks becoming NaN
+            converted = np.array(column, dtype=np.float64)
+            converted[np.isnan(converted)] = 0
+            return converted
+        # Numbers stored as text are read with int() for integer metrics and
+        # float() for the others, as the per-row code did; columns with
+        # allowed values take no text
+        parse = int if idx in kernel.truncated_columns else float
+        column = cells(idx)
+        for n, value in enumerate(column):
+            if isinstance(value, str):
+                try:
+                    if allowed is not None:
+                        raise ValueError()
+                    column[n] = parse(value)
+                except ValueError:
+                    raise ValueError(f"Invalid value for '{kernel.headers[idx]}': {value}") from None
+        return column.astype(np.float64)
+
+    category = cells(kernel.category_column)
+    unknown = set(category) - set(SUMMARY_CATEGORY_ROWS)
+    if unknown:
+        raise ValueError(f"Invalid value for '{kernel.headers[kernel.category_column]}': {', '.join(map(str, unknown))}")
+
+    values = {}
+    for idx, is_flag, allowed in kernel.value_columns:
+        if is_flag:
+            values[idx] = cells(idx).astype(bool).astype(np.float64)
+            continue
+        values[idx] = numbers(idx, allowed)
+        if allowed is not None:
+            invalid = ~np.isin(values[idx], allowed)
+            if invalid.any():
+                raise ValueError(f"Invalid value for '{kernel.headers[idx]}': {np.array(columns[idx], dtype=object)[invalid][0]}")
+    truncated = {idx: np.trunc(values[idx]).astype(np.int64) for idx in kernel.truncated_columns}
+
+    metrics = []
+    for sources, is_int in kernel.metrics:
+        if not sources:
+            metrics.append(np.ones(len(category), dtype=np.int64))
+            continue
+        # Added left to right, as the sheet's own formulas would
+        source = truncated if is_int else values
+        total = source[sources[0]]
+        for idx in sources[1:]:
+            total = total + source[idx]
+        metrics.append(total)
+    return category, metrics
+
+
+def empty_summary_row():
+    """The metric values of a category without hospitals."""
+    return list(METRIC_KERNEL.empty_row)
+
+
+class SummaryAccumulator:
+    """Running per-category totals of SUMMARY_METRICS, one array per metric."""
+
+    def __init__(self):
+        import numpy as np
+
+        self.categories = list(SUMMARY_CATEGORY_ROWS)
+        self.codes = {category: code for code, category in enumerate(self.categories)}
+        self.totals = [np.zeros(len(self.categories), dtype=np.int64 if is_int else np.float64)
+                       for _, is_int in METRIC_KERNEL.metrics]
+
+    def add(self, records):
+        """Add a batch of raw detail records."""
+        import numpy as np
+
+        category, metrics = detail_metrics(records)
+        codes = np.fromiter((self.codes[key] for key in category), dtype=np.intp, count=len(category))
+        for total, values in zip(self.totals, metrics):
+            if values.dtype.kind == 'i':
+                np.add.at(total, codes, values)
+                continue
+            # cumsum adds strictly left to right, so the float totals match
+            # a row-by-row accumulation bit for bit.
+            for code in np.unique(codes):
+                total[code] = np.cumsum(np.append(total[code], values[codes == code]))[-1]
+
+    def summary_data(self):
+        """The totals as the per-category value lists written to the summary sheet."""
+        columns = [total.tolist() for total in self.totals]
+        return {category: [column[code] for column in columns] for code, category in enumerate(self.categories)}
+
+
+def current_rss_bytes():
+    """Resident set size of this process right now, 0 where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * mmap.PAGESIZE
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class StageTimings:
+    """Seconds spent in each stage of a job, the detail rows it read and its peak memory.
+
+    A stage timed several times adds up, and one timed inside another is not
+    counted in the outer one; the timings of worker processes are merged into
+    the job's. peak_rss is the largest resident set size sampled when a stage
+    starts or ends, over the job's process and its workers.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.rows = 0
+        self.current = None  # Stage entered last, or the outer one again once a nested stage ends
+        self.peak_rss = 0
+        self._nested_seconds = []  # Time spent in nested stages, per open stage
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        outer = self.current if self._nested_seconds else None
+        self.current = name
+        self.sample_rss()
+        self._nested_seconds.append(0.0)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            self.add(name, seconds - self._nested_seconds.pop())
+            if self._nested_seconds:
+                self._nested_seconds[-1] += seconds
+                self.current = outer
+            self.sample_rss()
+
+    def sample_rss(self):
+        self.peak_rss = max(self.peak_rss, current_rss_bytes())
+
+    def add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def merge(self, other):
+        for name, seconds in other.seconds.items():
+            self.add(name, seconds)
+        self.rows += other.rows
+        self.current = other.current or self.current
+        self.peak_rss = max(self.peak_rss, other.peak_rss)
+
+
+def summarize_large_data(large_data, processing_logger, stop_event, progress=None, row_log=False, columns=None,
+                         timings=None, on_batch=None):
+    """Summarize the detail rows per hospital category.
+
+    progress, if given, is called after every batch with the rows processed so
+    far, the current category and the running totals. With row_log each
+    hospital row is also logged as a compact JSON record. columns is passed on
+    to iter_detail_records. timings, a StageTimings, gets the time spent
+    waiting for rows ("parse") and aggregating them ("summarize"). stop_event
+    is looked at before every batch and every CANCEL_CHECK_ROWS logged rows.
+    on_batch, if given, is called with every batch of raw detail records once
+    it is summarized, in slices of ON_BATCH_ROWS; its time goes to the
+    "history" stage.
+    """
+    processing_logger.info("Summarizing large Excel data")
+    if stop_event.is_set():
+        processing_logger.warning("Processing stopped by user during summarization.")
+        return None
+
+    if timings is None:
+        timings = StageTimings()
+    accumulator = SummaryAccumulator()
+    field_names = METRIC_KERNEL.headers
+    rows_processed = 0
+    category = None
+    batches = iter_batches(iter_detail_records(large_data, columns), SUMMARY_CHUNK_ROWS, PROGRESS_INTERVAL_SECONDS)
+    try:
+        while True:
+            # Rows are read lazily, so fetching a batch is where the workbook gets parsed
+            with timings.stage('parse'):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            with timings.stage('summarize'):
+                if stop_event.is_set():
+                    raise ProcessingStopped()
+                if row_log:
+                    for n, record in enumerate(batch):
+                        if n % CANCEL_CHECK_ROWS == 0 and stop_event.is_set():
+                            raise ProcessingStopped()
+                        row = {key: normalize_detail_value(value) for key, value in zip(field_names, record)}
+                        processing_logger.info(json.dumps(row, ensure_ascii=False, separators=(',', ':')))
+                accumulator.add(batch)
+            if on_batch is not None:
+                with timings.stage('history'):
+                    for start in range(0, len(batch), ON_BATCH_ROWS):
+                        if stop_event.is_set():
+                            raise ProcessingStopped()
+                        on_batch(batch[start:start + ON_BATCH_ROWS])
+            rows_processed += len(batch)
+            timings.rows += len(batch)
+            category = batch[-1][METRIC_KERNEL.category_column]
+            if progress is not None:
+                progress(rows=rows_processed, category=category, totals=accumulator.summary_data())
+    except ProcessingStopped:
+        processing_logger.warning(f"Processing stopped by user during summarization, after {rows_processed} hospital rows.")
+        return None
+
+    processing_logger.info(f"Summarized {rows_processed} hospital rows")
+    summary_data = accumulator.summary_data()
+    if progress is not None:
+        progress(final=True, rows=rows_processed, category=category, totals=summary_data)
+    return summary_data
+
+
+def get_xlwt_style(xlrd_book, xf_index):
+    """Get the xlwt style for an xlrd XF record."""
+    import xlwt
+
+    xf = xlrd_book.xf_list[xf_index]
+    
+    # Create an xlwt font
+    font = xlrd_book.font_list[xf.font_index]
+    xlwt_font = xlwt.Font()
+    xlwt_font.height = font.height
+    xlwt_font.italic = font.italic
+    xlwt_font.struck_out = font.struck_out
+    xlwt_font.outline = font.outline
+    xlwt_font.shadow = font.shadow
+    xlwt_font.colour_index = font.colour_index
+    xlwt_font.bold = font.bold
+    xlwt_font._weight = font.weight
+    xlwt_font.escapement = font.escapement
+    xlwt_font.underline = font.underline_type
+    xlwt_font.family = font.family  # Preserve font family
+    xlwt_font.name = font.name  # Preserve font family
+    xlwt_font.charset = font.character_set
+
+    # Create an xlwt borders
+    borders = xlwt.Borders()
+    borders.left = xf.border.left_line_style
+    borders.right = xf.border.right_line_style
+    borders.top = xf.border.top_line_style
+    borders.bottom = xf.border.bottom_line_style
+    borders.left_colour = xf.border.left_colour_index
+    borders.right_colour = xf.border.right_colour_index
+    borders.top_colour = xf.border.top_colour_index
+    borders.bottom_colour = xf.border.bottom_colour_index
+
+    # Create an xlwt alignment
+    alignment = xlwt.Alignment()
+    alignment.horz = xf.alignment.hor_align
+    alignment.vert = xf.alignment.vert_align
+    alignment.wrap = xf.alignment.text_wrapped
+
+    # Create an xlwt pattern
+    pattern = xlwt.Pattern()
+    pattern.pattern = xf.background.fill_pattern
+    pattern.pattern_fore_colour = xf.background.pattern_colour_index
+    pattern.pattern_back_colour = xf.background.background_colour_index
+
+    # Create an xlwt style with the font, borders, alignment, pattern and number format
+    style = xlwt.XFStyle()
+    style.font = xlwt_font
+    style.borders = borders
+    style.alignment = alignment
+    style.pattern = pattern
+    if xf.format_key in xlrd_book.format_map:
+        style.num_format_str = xlrd_book.format_map[xf.format_key].format_str
+
+    return style
+
+
+class XlwtStyleCache:
+    """xlwt styles of an xlrd workbook, translated once per distinct XF index."""
+
+    def __init__(self, xlrd_book):
+        self.xlrd_book = xlrd_book
+        self._styles = {}
+
+    def cell_style(self, xlrd_sheet, row, col):
+        """Style of the given cell, or of the row's first cell if the sheet doesn't reach that column."""
+        try:
+            xf_index = xlrd_sheet.cell_xf_index(row, col)
+        except IndexError:
+            xf_index = xlrd_sheet.cell_xf_index(row, 0)
+        style = self._styles.get(xf_index)
+        if style is None:
+            style = self._styles[xf_index] = get_xlwt_style(self.xlrd_book, xf_index)
+        return style
+
+
+def summarize_detail(file_name, file_path, processing_logger, stop_event, progress=None, row_log=False, file_contents=None,
+                     timings=None, on_batch=None):
+    """Stream, validate and summarize one detail workbook; None if it can't be read or was stopped.
+
+    timings, a StageTimings, gets the parse, validate and summarize times;
+    on_batch is passed on to summarize_large_data.
+    """
+    if timings is None:
+        timings = StageTimings()
+    with timings.stage('parse'):
+        large_rows = read_excel_rows(file_path, processing_logger, stop_event, file_contents=file_contents)
+    if large_rows is None:
+        return None
+    try:
+        # Only the rows the schema probe looks at are kept, the rest flow
+        # straight into the summarizer.
+        with timings.stage('parse'):
+            try:
+                large_header = list(itertools.islice(large_rows, SCHEMA_PROBE_ROWS))
+            except ProcessingStopped:
+                processing_logger.warning("Processing stopped by user during file read.")
+                return None
+        with timings.stage('validate'):
+            schema = validate_large_data(file_name, large_header, processing_logger)
+        columns = schema.column_list()
+        large_rows.max_col = max(columns) + 1
+        return summarize_large_data(itertools.chain(large_header, large_rows), processing_logger, stop_event,
+                                    progress=progress, row_log=row_log, columns=columns, timings=timings,
+                                    on_batch=on_batch)
+    finally:
+        large_rows.close()
+
+
+class RecordingHandler(logging.Handler):
+    """Collect log records in a worker process so the job can replay them."""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+
+def summarize_detail_in_worker(file_name, file_path, file_contents=None, row_log=False, stop_path=None, on_batch=None):
+    """Entry point of the detail process pools.
+
+    Returns (summarized_data, log records, StageTimings, on_batch). on_batch,
+    passed on to summarize_large_data, has to be picklable; it is returned
+    as the worker left it, so a callback object can report back what it did.
+    The worker stops, returning None, once a file exists at stop_path.
+    """
+    processing_logger = logging.Logger(file_name, logging.INFO)
+    handler = RecordingHandler()
+    processing_logger.addHandler(handler)
+    timings = StageTimings()
+    stop_event = StopFile(stop_path) if stop_path else Event()
+    try:
+        summarized_data = summarize_detail(file_name, file_path, processing_logger, stop_event,
+                                           row_log=row_log, file_contents=file_contents, timings=timings,
+                                           on_batch=on_batch)
+    except Exception as e:
+        raise ValueError(f"{file_name}: {e}") from None
+    return summarized_data, handler.records, timings, on_batch
+
+
+def merge_summaries(partials):
+    """Add up the per-category summaries of several detail workbooks."""
+    merged = {}
+    for summarized_data in partials:
+        for key, value_list in summarized_data.items():
+            if key in merged:
+                merged[key] = [total + value for total, value in zip(merged[key], value_list)]
+            else:
+                merged[key] = list(value_list)
+    return merged
+
+
+def render_summary(file_name, summary_book, summary_sheet, summarized_data, schema):
+    """Write the summarized data into the summary workbook, preserving its format, and return the file contents.
+
+    schema is the summary sheet's SheetSchema, from validate_summary_data.
+    """
+    output = io.BytesIO()
+    if file_name.endswith('.xlsx'):
+        summary_sheet = summary_book.active
+        for key, row_idx in schema.category_rows.items():
+            for location, value in enumerate(summarized_data[key], 1):
+                summary_sheet.cell(row=row_idx + 1, column=schema.columns[location] + 1).value = value
+        summary_book.save(output)
+    else:
+        from xlutils.copy import copy as xl_copy
+        wb = xl_copy(summary_book)
+        ws = wb.get_sheet(0)
+        style_cache = XlwtStyleCache(summary_book)
+        for key, row_idx in schema.category_rows.items():
+            for location, value in enumerate(summarized_data[key], 1):
+                col_idx = schema.columns[location]
+                ws.write(row_idx, col_idx, value, style_cache.cell_style(summary_sheet, row_idx, col_idx))
+        wb.save(output)
+    return output.getvalue()
@@ -0,0 +1,215 @@
+"""Fast values-only reader of .xlsx worksheets.
+
+openpyxl builds a cell object for every cell it reads, even in read-only
+mode, and resolves its style to tell dates from numbers. The detail sheets
+only need the values of their first columns, so XlsxReader streams the
+worksheet XML and the shared strings straight out of the zip through an
+expat parser and keeps nothing but the values of the columns asked for.
+
+Numbers come out as int or float, shared and inline strings as str,
+booleans as bool and errors as their text (e.g. '#DIV/0!'). Formulas give
+their cached value. Number formats are not looked at, so dates stay serial
+numbers.
+"""
+import posixpath
+import zipfile
+from xml.etree import ElementTree
+from xml.parsers import expat
+
+CHUNK_BYTES = 16 * 1024  # Uncompressed sheet XML parsed at a time; the rows in it are yielded together
+
+REL_OFFICE_DOCUMENT = '/officeDocument'  # Suffix of the relationship types looked up
+REL_SHARED_STRINGS = '/sharedStrings'
+
+
+def local_name(tag):
+    """Tag without its namespace, for expat ('uri local') and ElementTree ('{uri}local') names."""
+    return tag.rpartition('}')[2].rpartition(' ')[2]
+
+
+def column_index(letters):
+    """0-based index of a column given by its letters, e.g. 'AB' -> 27."""
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - 64
+    return index - 1
+
+
+def cast_number(text):
+    return float(text) if '.' in text or 'E' in text or 'e' in text else int(text)
+
+
+class XlsxReader:
+    """The active sheet of an .xlsx workbook, read row by row.
+
+    source is a path or a binary file object. Opening reads the workbook
+    parts and the shared strings; iter_rows then streams the sheet. Raises
+    zipfile.BadZipFile or KeyError for files that are not workbooks.
+    """
+
+    def __init__(self, source):
+        self.zip = zipfile.ZipFile(source)
+        try:
+            workbook_path = self._relationship_targets('')[REL_OFFICE_DOCUMENT][0]
+            workbook = ElementTree.fromstring(self.zip.read(workbook_path))
+            targets = self._relationship_targets(workbook_path)
+            sheets = [element for element in workbook.iter() if local_name(element.tag) == 'sheet']
+            active = 0
+            for element in workbook.iter():
+                if local_name(element.tag) == 'workbookView':
+                    active = int(element.get('activeTab', 0))
+                    break
+            sheet = sheets[active if active < len(sheets) else 0]
+            sheet_id = next(value for name, value in sheet.attrib.items() if local_name(name) == 'id')
+            self.sheet_path = targets['ids'][sheet_id]
+            shared_strings_paths = targets.get(REL_SHARED_STRINGS)
+            self.shared_strings = self._read_shared_strings(shared_strings_paths[0]) if shared_strings_paths else []
+        except Exception:
+            self.zip.close()
+            raise
+
+    def _relationship_targets(self, part_path):
+        """Targets of the relationships of a part, by type suffix and under 'ids' by id."""
+        folder, name = posixpath.split(part_path)
+        rels_path = posixpath.join(folder, '_rels', name + '.rels')
+        targets = {'ids': {}}
+        for element in ElementTree.fromstring(self.zip.read(rels_path)):
+            target = element.get('Target')
+            if target.startswith('/'):
+                target = target[1:]
+            else:
+                target = posixpath.normpath(posixpath.join(folder, target))
+            rel_type = element.get('Type', '')
+            targets.setdefault(rel_type[rel_type.rfind('/'):], []).append(target)
+            targets['ids'][element.get('Id')] = target
+        return targets
+
+    def _read_shared_strings(self, path):
+        strings = []
+        parts = []
+        state = {'text': False, 'phonetic': 0}
+
+        def start(name, attrs):
+            name = local_name(name)
+            if name == 't':
+                state['text'] = not state['phonetic']
+            elif name == 'rPh':
+                state['phonetic'] += 1
+            elif name == 'si':
+                parts.clear()
+
+        def end(name):
+            name = local_name(name)
+            if name == 't':
+                state['text'] = False
+            elif name == 'rPh':
+                state['phonetic'] -= 1
+            elif name == 'si':
+                strings.append(''.join(parts))
+
+        def data(text):
+            if state['text']:
+                parts.append(text)
+
+        parser = expat.ParserCreate(namespace_separator=' ')
+        parser.buffer_text = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = data
+        with self.zip.open(path) as stream:
+            parser.ParseFile(stream)
+        return strings
+
+    def iter_rows(self, max_col=None):
+        """Yield the value tuple of every row of the sheet, from row 1 on.
+
+        Rows end at their last cell; rows missing from the sheet come out as
+        (). Cells from the 0-based column max_col on are skipped. max_col may
+        be a callable returning it, looked up again for every row.
+        """
+        shared_strings = self.shared_strings
+        get_max_col = max_col if callable(max_col) else (lambda: max_col)
+        rows = []  # Rows parsed from the current chunk
+        cells = []
+        columns = {}  # Column letters -> index
+        names = {}  # Element name -> name without namespace prefix
+        row_number, col, limit = 0, -1, None
+        cell_type = None  # Type of the current cell, None if it is skipped
+        text, in_text, phonetic = '', False, False
+
+        def start(name, attrs):
+            nonlocal row_number, col, limit, cell_type, text, in_text, phonetic
+            tag = names.get(name) or names.setdefault(name, name.rpartition(':')[2])
+            if tag == 'c':
+                ref = attrs.get('r')
+                if ref:
+                    letters = ref.rstrip('0123456789')
+                    col = columns.get(letters)
+                    if col is None:
+                        col = columns[letters] = column_index(letters)
+                else:
+                    col += 1
+                cell_type = attrs.get('t', 'n') if limit is None or col < limit else None
+                text = ''
+            elif tag == 'v' or tag == 't':
+                in_text = cell_type is not None and not phonetic
+            elif tag == 'row':
+                ref = attrs.get('r')
+                number = int(ref) if ref else row_number + 1
+                # Rows without cells may be left out of the XML
+                for _ in range(row_number + 1, number):
+                    rows.append(())
+                row_number, col, limit = number, -1, get_max_col()
+                cells.clear()
+            elif tag == 'rPh':
+                # Phonetic runs of inline strings are not part of the value
+                phonetic = True
+
+        def end(name):
+            nonlocal in_text, phonetic
+            tag = names[name]
+            if tag == 'c':
+                if cell_type is None:
+                    return
+                if not text and cell_type != 'inlineStr':
+                    value = None
+                elif cell_type == 'n':
+                    value = cast_number(text)
+                elif cell_type == 's':
+                    value = shared_strings[int(text)]
+                elif cell_type == 'b':
+                    value = text == '1'
+                else:
+                    # str (formula text), inlineStr, e (error) and d (ISO 8601 date)
+                    value = text
+                if col >= len(cells):
+                    cells.extend([None] * (col - len(cells) + 1))
+                cells[col] = value
+            elif tag == 'v' or tag == 't':
+                in_text = False
+            elif tag == 'row':
+                rows.append(tuple(cells))
+            elif tag == 'rPh':
+                phonetic = False
+
+        def data(chunk):
+            nonlocal text
+            if in_text:
+                text += chunk
+
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = data
+        with self.zip.open(self.sheet_path) as stream:
+            while True:
+                chunk = stream.read(CHUNK_BYTES)
+                parser.Parse(chunk, not chunk)
+                yield from rows
+                rows.clear()
+                if not chunk:
+                    break
+
+    def close(self):
+        self.zip.close()